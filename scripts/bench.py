@@ -0,0 +1,282 @@
+'''
+Benchmark suite for the hot paths of the server, run in-process without networking.
+
+Each case runs in a fresh process, repeats its measurement and keeps the fastest run, so results are
+comparable between runs on the same machine. Times are per operation, or per object for the tree cases.
+
+    create        create_object throughput, flat under one parent
+    destroy       destroy_object throughput, flat under one parent
+    deep          building a chain of nested objects
+    wide          building one object with many children, in one create_objects call
+    transition/D  recording a transition on an object D levels deep (history attribution and LCA)
+    undo, redo    latency of one undo or redo in a document of the given size
+    serialize     serialize() of a tree of the given size
+    deserialize   restoring that tree with _create_object
+    memory        peak traced memory while building and serializing a tree
+
+usage:
+    python scripts/bench.py [--size N] [--cases a,b,...]            run and print the results
+    python scripts/bench.py ... --save scripts/bench_baseline.json   also store them as the baseline
+    python scripts/bench.py ... --compare scripts/bench_baseline.json [--tolerance 0.25]
+
+--compare exits with status 1 if a case is slower, or uses more memory, than the baseline by more than the
+tolerance. Baselines only mean something on the machine that made them, so save a new one before working
+on a change, and compare against it after.
+'''
+import argparse
+import gc
+import json
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import objectsync
+from objectsync.count import set_id_count
+
+REPEATS = 5
+DEPTHS = (1, 10, 100, 1000)
+
+class Node(objectsync.SObject):
+    frontend_type = 'node'
+    def build(self):
+        self.label = self.add_attribute('label', objectsync.StringTopic, 'node')
+        self.position = self.add_attribute('position', objectsync.ListTopic, [0, 0])
+        self.style = self.add_attribute('style', objectsync.DictTopic, {'color': 'black', 'width': 100})
+
+def make_server():
+    set_id_count(0)
+    # the port is only bound by serve(), which the benchmarks never call
+    server = objectsync.Server(port=0)
+    server.register(Node)
+    return server
+
+def build_tree(server, n):
+    ''' Groups of 100 nodes under one top node: a chain 10 deep, each link with 9 leaf children '''
+    with server.record():
+        top = server.create_object(Node)
+        for _ in range(max(1, n // 100)):
+            parent = top
+            for _ in range(10):
+                parent = server.create_object(Node, parent.get_id())
+                for _ in range(9):
+                    server.create_object(Node, parent.get_id())
+    return top
+
+def build_chain(server, depth):
+    with server.record():
+        obj = server.get_root_object()
+        for _ in range(depth):
+            obj = server.create_object(Node, obj.get_id())
+    return obj
+
+def timed(setup, run, repeats=REPEATS):
+    '''
+    Returns the fastest of repeats runs of run(setup()). The garbage collector is off while timing.
+    '''
+    best = float('inf')
+    for _ in range(repeats):
+        state = setup()
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            run(state)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return best
+
+'''
+Cases. Each returns the name and value of its metrics: seconds per operation, or bytes.
+'''
+
+def bench_create(n):
+    def setup():
+        server = make_server()
+        return server, build_chain(server, 1).get_id()
+    def run(state):
+        server, parent_id = state
+        with server.record():
+            for _ in range(n):
+                server.create_object(Node, parent_id)
+    return {'seconds': timed(setup, run) / n}
+
+def bench_destroy(n):
+    def setup():
+        server = make_server()
+        parent = build_chain(server, 1)
+        with server.record():
+            ids = [server.create_object(Node, parent.get_id()).get_id() for _ in range(n)]
+        return server, ids
+    def run(state):
+        server, ids = state
+        with server.record():
+            for id in ids:
+                server.destroy_object(id)
+    return {'seconds': timed(setup, run) / n}
+
+def bench_deep(n):
+    # deeper chains only test the recursion limit
+    depth = min(n, 500)
+    def run(server):
+        build_chain(server, depth)
+    return {'seconds': timed(make_server, run) / depth}
+
+def bench_wide(n):
+    def setup():
+        server = make_server()
+        return server, build_chain(server, 1).get_id()
+    def run(state):
+        server, parent_id = state
+        with server.record():
+            server.create_objects([{'type': Node, 'parent_id': parent_id} for _ in range(n)])
+    return {'seconds': timed(setup, run) / n}
+
+def bench_transition(depth, count=200):
+    def setup():
+        server = make_server()
+        return server, build_chain(server, depth)
+    def run(state):
+        server, leaf = state
+        for i in range(count):
+            with server.record():
+                leaf.label.set(f'label {i}')
+    return {'seconds': timed(setup, run) / count}
+
+def _undo_setup(n, count):
+    server = make_server()
+    top = build_tree(server, n)
+    nodes = list(top.traverse(type=Node))
+    for i in range(count):
+        with server.record():
+            nodes[i * 7919 % len(nodes)].style.change_value('width', i)
+    return server
+
+def bench_undo(n, count=200):
+    def run(server):
+        for _ in range(count):
+            server._undo()
+    return {'seconds': timed(lambda: _undo_setup(n, count), run) / count}
+
+def bench_redo(n, count=200):
+    def setup():
+        server = _undo_setup(n, count)
+        for _ in range(count):
+            server._undo()
+        return server
+    def run(server):
+        for _ in range(count):
+            server._redo()
+    return {'seconds': timed(setup, run) / count}
+
+def bench_serialize(n):
+    server = make_server()
+    top = build_tree(server, n)
+    count = len(server.get_objects()) - 1
+    return {'seconds': timed(lambda: top, lambda top: top.serialize(), repeats=3) / count}
+
+def bench_deserialize(n):
+    server = make_server()
+    serialized = build_tree(server, n).serialize()
+    count = len(server.get_objects()) - 1
+    del server
+    def setup():
+        return make_server()
+    def run(server):
+        with server.record():
+            server._create_object(serialized.type, 'root', serialized.id, serialized)
+    return {'seconds': timed(setup, run, repeats=3) / count}
+
+def bench_memory(n):
+    gc.collect()
+    tracemalloc.start()
+    server = make_server()
+    top = build_tree(server, n)
+    top.serialize()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'peak_bytes': peak, 'bytes_per_object': peak / (len(server.get_objects()) - 1)}
+
+def all_cases():
+    cases = ['create', 'destroy', 'deep', 'wide']
+    cases += [f'transition/{depth}' for depth in DEPTHS]
+    cases += ['undo', 'redo', 'serialize', 'deserialize', 'memory']
+    return cases
+
+def run_case(case, n):
+    name, _, arg = case.partition('/')
+    function = globals()[f'bench_{name}']
+    return function(int(arg)) if arg else function(n)
+
+'''
+Running, saving and comparing
+'''
+
+def run_all(cases, n):
+    results = {}
+    for case in cases:
+        out = subprocess.run([sys.executable, __file__, '--run', case, str(n)], capture_output=True, text=True)
+        if out.returncode != 0:
+            print(f'{case:16} failed\n{out.stderr}')
+            continue
+        results[case] = json.loads(out.stdout.strip().splitlines()[-1])
+        print(f'{case:16} ' + '  '.join(format_metric(metric, value) for metric, value in results[case].items()), flush=True)
+    return results
+
+def format_metric(metric, value):
+    if metric == 'seconds':
+        return f'{value * 1e6:10.2f} us'
+    if metric == 'peak_bytes':
+        return f'{value / 2**20:8.1f} MB peak'
+    return f'{value:10.0f} {metric}'
+
+def compare(results, baseline, tolerance):
+    '''
+    Prints the change of each metric against the baseline and returns the regressions.
+    '''
+    if baseline['size'] != results['size']:
+        print(f'warning: the baseline was run with --size {baseline["size"]}, not {results["size"]}')
+    regressions = []
+    for case, metrics in results['cases'].items():
+        for metric, value in metrics.items():
+            old = baseline['cases'].get(case, {}).get(metric)
+            if not old:
+                continue
+            ratio = value / old
+            flag = ''
+            if ratio > 1 + tolerance:
+                flag = '  REGRESSION'
+                regressions.append((case, metric, ratio))
+            print(f'{case:16} {metric:16} {ratio:6.2f}x{flag}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the server in-process.')
+    parser.add_argument('--size', type=int, default=10000, help='number of objects in the tree cases')
+    parser.add_argument('--cases', help='comma separated cases to run, all by default')
+    parser.add_argument('--save', metavar='FILE', help='store the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results against a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown before a case counts as a regression')
+    args = parser.parse_args()
+
+    cases = args.cases.split(',') if args.cases else all_cases()
+    results = {'size': args.size, 'python': sys.version.split()[0], 'cases': run_all(cases, args.size)}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} regressions beyond {args.tolerance:.0%}')
+            sys.exit(1)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        sys.setrecursionlimit(10000)
+        print(json.dumps(run_case(sys.argv[2], int(sys.argv[3]))))
+    else:
+        main()
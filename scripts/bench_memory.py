@@ -0,0 +1,54 @@
+'''
+Report the memory retained per object for a large tree, in the default and the lean mode.
+
+Each mode runs in a fresh process. Memory is measured with tracemalloc, so it counts the Python allocations
+of the objects, their topics and the server's indexes, but not the interpreter itself.
+Tracing has its own overhead: the process peaks at about 2.5 times the reported memory, over 20 GB at
+the default million objects. Per-object figures hold steady with size, so a smaller count gives the same result.
+
+usage: python scripts/bench_memory.py [number of objects]
+'''
+import json
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import objectsync
+
+class Node(objectsync.SObject):
+    frontend_type = 'node'
+    def build(self):
+        self.label = self.add_attribute('label', objectsync.StringTopic, 'node')
+
+def measure(lean, n):
+    tracemalloc.start()
+    server = objectsync.Server(port=0, lean=lean)
+    server.register(Node)
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    # groups of 100 nodes: a chain 10 deep, each link with 9 leaf children
+    with server.record():
+        for _ in range(max(1, n // 100)):
+            parent = server.get_root_object()
+            for _ in range(10):
+                parent = server.create_object(Node, parent.get_id())
+                for _ in range(9):
+                    server.create_object(Node, parent.get_id())
+    elapsed = time.perf_counter() - start
+    count = len(server.get_objects()) - 1
+    retained = tracemalloc.get_traced_memory()[0] - before
+    print(json.dumps({'objects': count, 'bytes_per_object': retained / count, 'seconds': elapsed}))
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    for mode in ('default', 'lean'):
+        out = subprocess.run([sys.executable, __file__, '--measure', mode, str(n)], capture_output=True, text=True, check=True)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        print(f'{mode:8} {result["objects"]} objects  {result["bytes_per_object"]:.0f} bytes/object  built in {result["seconds"]:.1f}s')
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--measure':
+        measure(sys.argv[2] == 'lean', int(sys.argv[3]))
+    else:
+        main()
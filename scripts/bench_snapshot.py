@@ -0,0 +1,93 @@
+'''
+Compare restoring a document from a binary snapshot against the JSON round trip
+(serialize() + to_dict() + json.dump, then json.load + SObjectSerialized + _create_object).
+
+Each restore runs in a fresh process so its peak RSS can be measured.
+
+usage: python scripts/bench_snapshot.py [number of objects]
+'''
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import objectsync
+from objectsync import SObjectSerialized
+
+class Node(objectsync.SObject):
+    frontend_type = 'node'
+    def build(self):
+        self.label = self.add_attribute('label', objectsync.StringTopic, 'node')
+        self.position = self.add_attribute('position', objectsync.ListTopic, [0, 0])
+        self.style = self.add_attribute('style', objectsync.DictTopic, {'color': 'black', 'width': 100})
+
+def make_server():
+    server = objectsync.Server(port=0)
+    server.register(Node)
+    return server
+
+def build_document(server, n):
+    # groups of 100 nodes: a chain 10 deep, each link with 9 leaf children
+    with server.record():
+        for _ in range(max(1, n // 100)):
+            parent = server.get_root_object()
+            for depth in range(10):
+                parent = server.create_object(Node, parent.get_id())
+                for _ in range(9):
+                    server.create_object(Node, parent.get_id())
+
+def from_dict(d) -> SObjectSerialized:
+    return SObjectSerialized(d['id'], d['type'], d['attributes'], {k: from_dict(v) for k, v in d['children'].items()},
+        d['user_attribute_references'], d['user_sobject_references'], d['wrapped_topics'])
+
+def save(n, json_path, snapshot_path):
+    server = make_server()
+    build_document(server, n)
+
+    start = time.perf_counter()
+    with open(json_path, 'w') as f:
+        json.dump([child.serialize().to_dict() for child in server.get_root_object().get_children()], f)
+    json_save = time.perf_counter() - start
+
+    start = time.perf_counter()
+    server.save_snapshot(snapshot_path)
+    snapshot_save = time.perf_counter() - start
+    return len(server.get_objects()), json_save, snapshot_save
+
+def load(mode, path):
+    server = make_server()
+    start = time.perf_counter()
+    if mode == 'json':
+        with open(path) as f:
+            data = json.load(f)
+        with server.record():
+            for d in data:
+                server._create_object(d['type'], 'root', d['id'], from_dict(d))
+    else:
+        server.load_snapshot(path)
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'objects': len(server.get_objects()), 'seconds': elapsed, 'peak_rss_mb': peak_kb / 1024}))
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, 'doc.json')
+        snapshot_path = os.path.join(tmp, 'doc.snap')
+        count, json_save, snapshot_save = save(n, json_path, snapshot_path)
+        print(f'{count} objects')
+        print(f'save  json {json_save:.2f}s {os.path.getsize(json_path)/2**20:.1f}MB   '
+              f'snapshot {snapshot_save:.2f}s {os.path.getsize(snapshot_path)/2**20:.1f}MB')
+        for mode, path in (('json', json_path), ('snapshot', snapshot_path)):
+            out = subprocess.run([sys.executable, __file__, '--load', mode, path], capture_output=True, text=True, check=True)
+            result = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f'load  {mode:8} {result["seconds"]:.2f}s peak RSS {result["peak_rss_mb"]:.0f}MB')
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--load':
+        load(sys.argv[2], sys.argv[3])
+    else:
+        main()
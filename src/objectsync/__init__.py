@@ -1,6 +1,6 @@
 from .server import Server
-from .sobject import SObject, SObjectSerialized
+from .sobject import SObject, SObjectSerialized, Attribute
 from topicsync.topic import Topic, IntTopic, SetTopic, DictTopic, StringTopic, ListTopic, GenericTopic, FloatTopic, EventTopic
 from objectsync.topic import ObjListTopic, ObjSetTopic, ObjDictTopic, ObjTopic, WrappedTopic
 
-__all__ = ['Server','SObject','Topic','IntTopic','SetTopic','DictTopic','StringTopic','ListTopic','GenericTopic','FloatTopic','EventTopic','ObjListTopic','ObjSetTopic','ObjDictTopic','ObjTopic','WrappedTopic','SObjectSerialized']
\ No newline at end of file
+__all__ = ['Server','SObject','Topic','IntTopic','SetTopic','DictTopic','StringTopic','ListTopic','GenericTopic','FloatTopic','EventTopic','ObjListTopic','ObjSetTopic','ObjDictTopic','ObjTopic','WrappedTopic','SObjectSerialized','Attribute']
\ No newline at end of file
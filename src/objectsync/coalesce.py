@@ -0,0 +1,156 @@
+'''
+Folding of successive changes on the same topic into their net effect.
+
+Changes are grouped by topic, and within a topic by what they touch:
+
+    - set changes: the whole value. Folds into one set from the first old value to the last value.
+    - int and float add changes: fold into one add of their sum.
+    - dict add, pop and change_value: grouped by key. Fold into the net add, pop or change_value of the key.
+    - set topic append and remove: grouped by item. Fold into the net append or remove of the item.
+
+A folded change takes the place of the change it stands for last, or first for a pop or remove, so the
+order of dict keys and set items comes out the same as applying all the changes. A group that has no net
+effect is dropped. Inverting the folded changes restores the state before the group, so undo stays correct.
+
+Topics are left alone while they receive other kinds of changes, which stop their groups. String topics
+are never folded, since clients refer to their changes by id. Events and changes of the topic list stop all
+the groups: event callbacks may read or recreate the topics, so no change is moved across them.
+'''
+from __future__ import annotations
+import json
+from typing import Dict, List, Tuple
+
+from topicsync.change import (Change, DictChangeTypes, EventChangeTypes, FloatChangeTypes, IntChangeTypes, SetChange,
+    SetChangeTypes, StringChangeTypes)
+
+_TOPIC_LIST = '_topicsync/topic_list'
+
+_SET = 0
+_DELTA = 1
+_DICT = 2
+_SET_ITEM = 3
+
+_DELTA_TYPES = (IntChangeTypes.AddChange, FloatChangeTypes.AddChange)
+_DICT_TYPES = (DictChangeTypes.AddChange, DictChangeTypes.PopChange, DictChangeTypes.ChangeValueChange)
+_SET_ITEM_TYPES = (SetChangeTypes.AppendChange, SetChangeTypes.RemoveChange)
+
+def _classify(change: Change) -> Tuple[int,object]|None:
+    '''
+    Returns the kind of change and the key of its group within the topic, or None if it can't be folded.
+    '''
+    if isinstance(change, SetChange):
+        if isinstance(change, StringChangeTypes.SetChange):
+            return None
+        return _SET, None
+    if isinstance(change, _DELTA_TYPES):
+        return _DELTA, None
+    if isinstance(change, _DICT_TYPES):
+        try:
+            hash(change.key)
+        except TypeError:
+            return None
+        return _DICT, change.key
+    if isinstance(change, _SET_ITEM_TYPES):
+        try:
+            return _SET_ITEM, json.dumps(change.item, sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+    return None
+
+def _is_barrier(change: Change) -> bool:
+    return change.topic_name == _TOPIC_LIST or isinstance(change, (EventChangeTypes.EmitChange, EventChangeTypes.ReversedEmitChange))
+
+def _net_changes(kind: int, positions: List[int], changes: List[Change]) -> List[Tuple[int,Change]]:
+    '''
+    The net effect of a group of changes, as changes placed at some of the group's positions.
+    '''
+    topic_name = changes[0].topic_name
+    first, last = changes[0], changes[-1]
+
+    if kind == _SET:
+        if first.old_value == last.value: # type: ignore
+            return []
+        return [(positions[-1], last.__class__(topic_name, last.value, first.old_value))] # type: ignore
+
+    if kind == _DELTA:
+        total = sum(change.value for change in changes) # type: ignore
+        if total == 0:
+            return []
+        return [(positions[-1], last.__class__(topic_name, total))]
+
+    if kind == _DICT:
+        key = first.key # type: ignore
+        last_add = max((i for i, change in enumerate(changes) if isinstance(change, DictChangeTypes.AddChange)), default=-1)
+        finally_present = not isinstance(last, DictChangeTypes.PopChange)
+        if isinstance(first, DictChangeTypes.AddChange):
+            if not finally_present:
+                return []
+            return [(positions[last_add], DictChangeTypes.AddChange(topic_name, key, last.value))] # type: ignore
+        # the key was there before the group
+        initial = first.value if isinstance(first, DictChangeTypes.PopChange) else first.old_value # type: ignore
+        if any(isinstance(change, DictChangeTypes.PopChange) for change in changes):
+            pop = DictChangeTypes.PopChange(topic_name, key)
+            pop.value = initial # what the inverse adds back
+            if not finally_present:
+                return [(positions[0], pop)]
+            return [(positions[0], pop), (positions[last_add], DictChangeTypes.AddChange(topic_name, key, last.value))] # type: ignore
+        if initial == last.value: # type: ignore
+            return []
+        return [(positions[-1], DictChangeTypes.ChangeValueChange(topic_name, key, last.value, initial))] # type: ignore
+
+    # _SET_ITEM: appends and removes of one item alternate
+    item = first.item # type: ignore
+    finally_present = isinstance(last, SetChangeTypes.AppendChange)
+    if isinstance(first, SetChangeTypes.AppendChange):
+        return [(positions[-1], SetChangeTypes.AppendChange(topic_name, item))] if finally_present else []
+    if not finally_present:
+        return [(positions[0], SetChangeTypes.RemoveChange(topic_name, item))]
+    return [(positions[0], SetChangeTypes.RemoveChange(topic_name, item)), (positions[-1], SetChangeTypes.AppendChange(topic_name, item))]
+
+def coalesce(changes: List[Change]) -> Tuple[List[Change],int]:
+    '''
+    Returns the changes with the successive changes on each topic folded, and how many changes were eliminated.
+    '''
+    result : List[Change|None] = list(changes)
+    # topic name -> (kind, group key -> (positions, changes))
+    open_topics : Dict[str,Tuple[int,Dict[object,Tuple[List[int],List[Change]]]]] = {}
+
+    def close(topic_name: str):
+        kind, groups = open_topics.pop(topic_name)
+        for positions, group in groups.values():
+            if len(group) < 2:
+                continue
+            net = _net_changes(kind, positions, group)
+            if len(net) == len(group):
+                continue
+            for position in positions:
+                result[position] = None
+            for position, change in net:
+                result[position] = change
+
+    for position, change in enumerate(changes):
+        if _is_barrier(change):
+            for topic_name in list(open_topics):
+                close(topic_name)
+            continue
+        topic_name = change.topic_name
+        classified = _classify(change)
+        topic = open_topics.get(topic_name)
+        if topic is not None and (classified is None or classified[0] != topic[0]):
+            close(topic_name)
+            topic = None
+        if classified is None:
+            continue
+        kind, key = classified
+        if topic is None:
+            topic = open_topics[topic_name] = (kind, {})
+        group = topic[1].get(key)
+        if group is None:
+            group = topic[1][key] = ([], [])
+        group[0].append(position)
+        group[1].append(change)
+    for topic_name in list(open_topics):
+        close(topic_name)
+
+    coalesced = [change for change in result if change is not None]
+    return coalesced, len(changes) - len(coalesced)
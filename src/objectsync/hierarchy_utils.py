@@ -4,35 +4,49 @@ from typing import TYPE_CHECKING, List
 if TYPE_CHECKING:
     from objectsync.sobject import SObject
 
+class AncestryNode:
+    '''
+    An immutable link in the chain of an object's ancestors.
+    A new node is made whenever the object or one of its ancestors is reparented, so
+    nodes kept by history items still describe the hierarchy at the time they were recorded.
+    '''
+    __slots__ = ('obj', 'parent')
+    def __init__(self, obj:'SObject', parent:'AncestryNode|None'):
+        self.obj = obj
+        self.parent = parent
+
 def get_ancestors(obj:'SObject') -> List['SObject']:
     '''
     Returns a list of all ancestors of obj, including itself, starting with the root
     '''
-    ancestors = []
-    while not obj.is_root():
+    ancestors = [obj]
+    while obj._parent is not None:
+        obj = obj._parent
         ancestors.append(obj)
-        obj = obj.get_parent()
-    ancestors.append(obj)
     ancestors.reverse()
     return ancestors
 
+def _lowest_common_ancestor_of_two(a:'SObject', b:'SObject') -> 'SObject':
+    # climb the deeper one until both are on the same level, then climb together
+    while a._depth > b._depth:
+        a = a._parent # type: ignore
+    while b._depth > a._depth:
+        b = b._parent # type: ignore
+    while a is not b:
+        a = a._parent # type: ignore
+        b = b._parent # type: ignore
+    return a
+
 def lowest_common_ancestor(objs:List['SObject']) -> 'SObject':
     '''
-    Returns the lowest common ancestor of two objects
+    Returns the lowest common ancestor of the objects
     '''
-
-    # traverse up the tree from obj1
-    all_ancestors = []
-    min_len = 10000
+    lowest = objs[0]
     for obj in objs:
-        ancestors = get_ancestors(obj)
-        all_ancestors.append(ancestors)
-        min_len = min(min_len,len(ancestors))
-
-    # find the lowest common ancestor
-    
-    for i in range(min_len):
-        for j in range(len(all_ancestors)):
-            if all_ancestors[j][i] != all_ancestors[0][i]:
-                return all_ancestors[j][i-1]
-    return all_ancestors[0][min_len-1]
\ No newline at end of file
+        # fast path: most transitions only touch one object
+        if obj is lowest:
+            continue
+        lowest = _lowest_common_ancestor_of_two(lowest, obj)
+        if lowest._parent is None:
+            break
+    return lowest
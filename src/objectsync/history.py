@@ -1,60 +1,409 @@
-from typing import Dict, List
+from __future__ import annotations
+from typing import TYPE_CHECKING, Any, Callable, Dict, FrozenSet, List, Tuple
 import logging
+import time
 logger = logging.getLogger(__name__)
 from topicsync import Transition
+from topicsync.change import Change, EventChangeTypes
+
+if TYPE_CHECKING:
+    from objectsync.sobject import SObject
+    from objectsync.hierarchy_utils import AncestryNode
+
+def estimate_size(value: Any) -> int:
+    '''
+    Rough number of bytes retained by a transition payload.
+    Strings count their length and other scalars count 8 bytes.
+    '''
+    size = 0
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, str):
+            size += len(value)
+        elif isinstance(value, (int, float, bool)) or value is None:
+            size += 8
+        elif isinstance(value, dict):
+            stack.extend(value.keys())
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            stack.extend(value)
+        elif hasattr(value, 'to_dict'): # SObjectSerialized in create/destroy payloads
+            stack.append(value.to_dict())
+        elif isinstance(getattr(value, '__dict__', None), dict): # Change
+            stack.extend(value.__dict__.values())
+        else:
+            size += 8
+    return size
+
+def _merge_key(transition: Transition) -> FrozenSet[str]|None:
+    '''
+    The topics a transition touches, or None if it can't be merged with others because it emits events.
+    '''
+    topics = set()
+    for change in transition.changes:
+        if isinstance(change, EventChangeTypes.EmitChange):
+            return None
+        topics.add(change.topic_name)
+    return frozenset(topics)
 
 class HistoryItem:
-    def __init__(self, transition: Transition, done: bool = False):
+    __slots__ = ('transition', 'done', 'ancestry', 'size', 'time', 'merge_key')
+    def __init__(self, transition: Transition, done: bool = False, ancestry: AncestryNode|None = None, size: int = 0):
         self.transition = transition
         self.done = done
+        self.ancestry = ancestry
+        ''' Ancestors of the object the transition was recorded in, at the time it was recorded '''
+        self.size = size
+        ''' Estimated bytes retained by the transition, 0 if the log has no byte budget '''
+        self.time = 0.0
+        ''' When the last transition merged into this item was recorded, only tracked when the log merges '''
+        self.merge_key : FrozenSet[str]|None = None
 
-class History:
-    def __init__(self,max_len=1000) -> None:
-        self.chain:List[HistoryItem] = []
-        self._current_index = -1
+class TransitionLog:
+    '''
+    Server-wide append-only log of committed transitions.
+
+    Every transition is stored once, tagged with the ancestry of the lowest object affected by it.
+    Each object's History is a view over this log that sees the transitions recorded in its subtree,
+    so recording a transition costs the same no matter how deep the object is.
+
+    Like the per-object chains it replaces, each view can undo at most max_len of the transitions it sees.
+    Items are kept in a ring buffer that grows as needed. Every time the log has grown by half, a sweep drops
+    the items that no view can reach anymore, which costs O(depth) per item, so O(depth) amortized per
+    transition but not on the path of every edit. Dropped items leave an empty slot until the oldest ones go.
+
+    If max_items is given, the oldest items are also evicted when the log holds more than max_items of them,
+    whichever view could still reach them. If max_bytes is given, they are evicted when their estimated payload
+    size exceeds it. A view whose undone items have all been evicted is back at the head of the log.
+
+    If merge_window is given, a transition recorded within merge_window seconds of the newest item is merged into
+    it when both touch the same topics, were recorded in the same object, come from the same source and emit no
+    events. A continuous interaction like a drag then takes one undo step, however many transitions it makes.
+    '''
+    def __init__(self, max_len=1000, max_bytes:int|None=None, merge_window:float|None=None, max_items:int|None=None) -> None:
+        self._capacity = max_items if max_items is not None else 64
+        self._buffer : List[HistoryItem|None] = [None] * self._capacity
+        self._base = 0 # absolute index of the oldest slot
+        self._len = 0 # number of slots in use, including the ones emptied by sweeps
+        self._live = 0 # number of items
         self.max_len = max_len
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._bytes = 0
+        self._sweep_at = 2 * max_len
+        self._detached_views : Dict[int,History] = {} # views that have undone something, keyed by id()
+        self.merge_window = merge_window
+        self.merged = 0
+        ''' Number of transitions merged into an earlier item '''
+
+    def add(self, transition: Transition, ancestry: AncestryNode, fold: Callable[[List[Change]],List[Change]]|None = None) -> None:
+        '''
+        fold is applied to the changes of merged transitions, e.g. to coalesce them.
+        '''
+        merge_key = None
+        if self.merge_window is not None:
+            now = time.monotonic()
+            merge_key = _merge_key(transition)
+            if merge_key is not None and self._try_merge(transition, ancestry, merge_key, now, fold):
+                return
+
+        size = estimate_size(transition.changes) if self.max_bytes is not None else 0
+        item = HistoryItem(transition, done=True, ancestry=ancestry, size=size)
+        if merge_key is not None:
+            item.merge_key = merge_key
+            item.time = now
+        index = self._base + self._len
+
+        # Prune the unreachable redo branch of every view that sees the new item
+        for key, view in list(self._detached_views.items()):
+            if view._sees(item):
+                view._truncate(index)
+                del self._detached_views[key]
+
+        if self._len == self._capacity:
+            if self.max_items is not None:
+                self._evict()
+            else:
+                self._grow()
+        self._buffer[index % self._capacity] = item
+        self._len += 1
+        self._live += 1
+        self._bytes += size
+        evicted = False
+        if self.max_bytes is not None:
+            # always keep the newest item so it can be undone
+            while self._bytes > self.max_bytes and self._live > 1:
+                self._evict()
+                evicted = True
+        if self._len >= self._sweep_at:
+            self._sweep()
+        if evicted or self.max_items is not None:
+            self._drop_stale_views()
+
+    def _try_merge(self, transition: Transition, ancestry: AncestryNode, merge_key: FrozenSet[str], now: float,
+            fold: Callable[[List[Change]],List[Change]]|None) -> bool:
+        if self._len == 0:
+            return False
+        last = self[self._base + self._len - 1]
+        if last is None or not last.done or last.merge_key != merge_key or last.ancestry is not ancestry \
+                or now - last.time > self.merge_window or last.transition.action_source != transition.action_source: # type: ignore
+            return False
+        # a view that sees the item may have undone it, or undo past it later and expect it as it was
+        for view in self._detached_views.values():
+            if view._sees(last):
+                return False
+        changes = last.transition.changes + transition.changes
+        if fold is not None:
+            changes = fold(changes)
+        # a new transition, so nothing that refers to the old one (like the journal) mistakes it for the merged one
+        last.transition = Transition(changes, transition.action_source)
+        last.time = now
+        self.merged += 1
+        if self.max_bytes is not None:
+            size = estimate_size(changes)
+            self._bytes += size - last.size
+            last.size = size
+        return True
+
+    def _grow(self) -> None:
+        capacity = self._capacity * 2
+        buffer : List[HistoryItem|None] = [None] * capacity
+        for index in range(self._base, self._base + self._len):
+            buffer[index % capacity] = self._buffer[index % self._capacity]
+        self._buffer = buffer
+        self._capacity = capacity
+
+    def _evict(self) -> None:
+        slot = self._base % self._capacity
+        item = self._buffer[slot]
+        if item is not None:
+            self._bytes -= item.size
+            self._live -= 1
+        self._buffer[slot] = None
+        self._base += 1
+        self._len -= 1
+
+    def _sweep(self) -> None:
+        '''
+        Empty the slots of the items that no view can reach: for every object that sees an item, the item is
+        more than max_len of the object's items back, or before its history starts, or in a pruned branch.
+        '''
+        counts : Dict[int,int] = {}
+        max_len = self.max_len
+        for index in range(self._base + self._len - 1, self._base - 1, -1):
+            slot = index % self._capacity
+            item = self._buffer[slot]
+            if item is None:
+                continue
+            reachable = False
+            node = item.ancestry
+            while node is not None:
+                obj = node.obj
+                view = obj._history
+                start = obj._history_start if view is None else view._start
+                if not obj._destroyed and index >= start and (view is None or not view._in_gap(index)):
+                    count = counts.get(id(obj), 0) + 1
+                    counts[id(obj)] = count
+                    if count <= max_len:
+                        reachable = True
+                node = node.parent
+            if not reachable:
+                self._buffer[slot] = None
+                self._bytes -= item.size
+                self._live -= 1
+        while self._len > 0 and self._buffer[self._base % self._capacity] is None:
+            self._base += 1
+            self._len -= 1
+        self._sweep_at = self._len + max(self._len // 2, self.max_len)
+
+    def _drop_stale_views(self) -> None:
+        # views whose cursor fell below the first index and whose redo branch was evicted too
+        for key, view in list(self._detached_views.items()):
+            if view._head < self._base:
+                view._cursor = None
+                view._undone = 0
+                del self._detached_views[key]
+
+    def clear(self) -> None:
+        while self._len > 0:
+            self._evict()
+        for view in self._detached_views.values():
+            view._reset()
+        self._detached_views.clear()
+
+    def first_index(self) -> int:
+        return self._base
+
+    def end_index(self) -> int:
+        return self._base + self._len
 
-    def add(self, transition: Transition):
-        # Prune unreachable chain
-        self.chain = self.chain[:self._current_index+1]
-        self.chain.append(HistoryItem(transition,done=True))
-        self._current_index += 1
-        if len(self.chain) > self.max_len:
-            self.chain = self.chain[1:]
-            self._current_index -= 1
+    def get_size(self) -> int:
+        ''' Estimated bytes retained by the items, only tracked when max_bytes is given '''
+        return self._bytes
+
+    def __len__(self) -> int:
+        return self._live
+
+    def __getitem__(self, index: int) -> HistoryItem|None:
+        ''' The item at the absolute index, None if it was dropped by a sweep '''
+        assert self._base <= index < self._base + self._len
+        return self._buffer[index % self._capacity]
+
+    def remeasure(self, index: int) -> None:
+        '''
+        Update the size of the item at index after its payload changed, e.g. undo filled the forward info of its events.
+        '''
+        if self.max_bytes is None:
+            return
+        item = self[index]
+        if item is None:
+            return
+        size = estimate_size(item.transition.changes)
+        self._bytes += size - item.size
+        item.size = size
+        evicted = False
+        while self._bytes > self.max_bytes and self._live > 1:
+            self._evict()
+            evicted = True
+        if evicted:
+            self._drop_stale_views()
+
+    def _detach(self, view: History) -> None:
+        self._detached_views[id(view)] = view
+
+    def _release(self, view: History) -> None:
+        ''' The view is back at the head of the log, or its owner is gone '''
+        self._detached_views.pop(id(view), None)
+
+class History:
+    '''
+    Undo/redo cursor of an object over the server's TransitionLog.
+
+    It sees the transitions whose lowest affected object was in the owner's subtree when they were recorded.
+    undo and redo step over the items of the log the view doesn't see, so they cost O(number of transitions
+    recorded outside the subtree since the previous or next transition of the view), not O(1).
+    '''
+    __slots__ = ('_log', '_owner', '_start', '_cursor', '_gaps', '_undone', '_head')
+    def __init__(self, log: TransitionLog, owner: SObject, start: int|None = None) -> None:
+        self._log = log
+        self._owner = owner
+        self._start = log.end_index() if start is None else start # items before this are not reachable
+        self._cursor : int|None = None # absolute index of the last done item, None if at the head of the log
+        self._gaps : List[Tuple[int,int]] = [] # pruned redo branches, as inclusive index ranges
+        self._undone = 0 # number of items undone since the head, the log's max_len at most
+        self._head = -1 # index of the newest item the view saw when it left the head
+
+    def _sees(self, item: HistoryItem) -> bool:
+        owner = self._owner
+        node = item.ancestry
+        while node is not None:
+            if node.obj is owner:
+                return True
+            node = node.parent
+        return False
+
+    def _in_gap(self, index: int) -> bool:
+        for lo, hi in self._gaps:
+            if lo <= index <= hi:
+                return True
+        return False
+
+    def _skip_gap_backward(self, index: int) -> int:
+        for lo, hi in reversed(self._gaps):
+            if lo <= index <= hi:
+                return lo - 1
+        return index
+
+    def _skip_gap_forward(self, index: int) -> int:
+        for lo, hi in self._gaps:
+            if lo <= index <= hi:
+                return hi + 1
+        return index
+
+    def _truncate(self, index: int) -> None:
+        # called by the log when a new item this view sees is added at index
+        assert self._cursor is not None
+        if self._cursor + 1 <= index - 1:
+            self._gaps.append((self._cursor + 1, index - 1))
+        lowest = max(self._start, self._log.first_index())
+        stale = 0
+        while stale < len(self._gaps) and self._gaps[stale][1] < lowest:
+            stale += 1
+        if stale:
+            del self._gaps[:stale]
+        self._cursor = None
+        self._undone = 0
+
+    def _reset(self) -> None:
+        self._cursor = None
+        self._gaps = []
+        self._undone = 0
 
     def clear(self):
         # This is used when some change is made that invalidates the history, in other words, some not undoable change.
-        self.chain = []
-        self._current_index = -1
+        self._start = self._log.end_index()
+        self._reset()
 
     def undo(self) -> Transition|None:
-        if self._current_index >= 0:
-            self.chain[self._current_index].done = False
-            self._current_index -= 1
-
-            debug_msg = '\n=== undo ===\n'
-            for change in reversed(self.chain[self._current_index+1].transition.changes):
-                debug_msg += str(change.serialize()) + '\n'
-            debug_msg += '\n'
-            logger.debug(debug_msg)
-
-            return self.chain[self._current_index+1].transition
-        else:
+        log = self._log
+        if self._undone >= log.max_len:
             return None
-        
-    def redo(self) -> Transition|None:
-        if self._current_index < len(self.chain)-1:
-            self._current_index += 1
-            self.chain[self._current_index].done = True
+        index = log.end_index() - 1 if self._cursor is None else self._cursor
+        lowest = max(self._start, log.first_index())
+        while index >= lowest:
+            skipped = self._skip_gap_backward(index)
+            if skipped != index:
+                index = skipped
+                continue
+            item = log[index]
+            if item is not None and self._sees(item):
+                item.done = False
+                if self._cursor is None:
+                    self._head = index
+                    log._detach(self)
+                self._cursor = index - 1
+                self._undone += 1
 
-            debug_msg = '\n=== redo ===\n'
-            for change in self.chain[self._current_index].transition.changes:
-                debug_msg += str(change.serialize()) + '\n'
-            debug_msg += '\n'
-            logger.debug(debug_msg)
+                if logger.isEnabledFor(logging.DEBUG):
+                    debug_msg = '\n=== undo ===\n'
+                    for change in reversed(item.transition.changes):
+                        debug_msg += str(change.serialize()) + '\n'
+                    debug_msg += '\n'
+                    logger.debug(debug_msg)
 
-            return self.chain[self._current_index].transition
-        else:
+                return item.transition
+            index -= 1
+        return None
+
+    def redo(self) -> Transition|None:
+        if self._cursor is None:
             return None
+        log = self._log
+        index = max(self._cursor + 1, self._start, log.first_index())
+        end = log.end_index()
+        while index < end:
+            skipped = self._skip_gap_forward(index)
+            if skipped != index:
+                index = skipped
+                continue
+            item = log[index]
+            if item is not None and self._sees(item):
+                item.done = True
+                self._cursor = index
+                self._undone -= 1
+                if self._undone == 0:
+                    # back at the head, new items have nothing to prune
+                    self._cursor = None
+                    log._release(self)
+
+                if logger.isEnabledFor(logging.DEBUG):
+                    debug_msg = '\n=== redo ===\n'
+                    for change in item.transition.changes:
+                        debug_msg += str(change.serialize()) + '\n'
+                    debug_msg += '\n'
+                    logger.debug(debug_msg)
 
+                return item.transition
+            index += 1
+        return None
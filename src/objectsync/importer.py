@@ -0,0 +1,218 @@
+'''
+Parallel import of serialized object trees.
+
+Importing a large document has two phases. Decoding the JSON, checking its structure and normalising it is
+pure data work, so it runs in a process pool, one input item per task. Creating the topics and objects has to
+happen on the server's thread, and is all that is left for it.
+
+An input item is the JSON text (or the decoded value) of one serialized object, as returned by
+SObjectSerialized.to_dict, or of a list of them. Workers hand back flat node rows in pre-order:
+
+    (id, type, attributes, subtree size, user attribute references, user sobject references, wrapped topics)
+
+Like in objectsync.snapshot, children are not stored explicitly: the children of row i start at i+1 and
+each is followed by its own subtree. Rows pickle much faster than nested SObjectSerialized, and the server
+reads them through a lazy children mapping.
+
+While normalising, workers
+    - convert the DEPRECATED 4 element attribute format to the 5 element one
+    - rename object types by type_map, like SObjectSerialized.update_type_names
+    - rename object ids by id_map, and update the references to them like SObjectSerialized.update_references
+'''
+from __future__ import annotations
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import json
+import os
+import re
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Tuple
+
+from topicsync.topic import Topic
+
+from objectsync.sobject import SObjectSerialized
+
+if TYPE_CHECKING:
+    from objectsync.server import Server
+    from objectsync.sobject import SObject
+
+Row = Tuple[str, str, List[List], int, Dict[str,str], Dict[str,str], List[str]]
+
+_generated_id_pattern = re.compile(r'0_(\d+)')
+
+_ID = 0
+_TYPE = 1
+_SIZE = 3
+
+def _normalise_attribute(attribute: Any, renamed: bool, path: str) -> List:
+    if not isinstance(attribute, list) or len(attribute) not in (3, 4, 5):
+        raise ValueError(f'{path}: an attribute must be a list of 3, 4 or 5 elements, got {attribute!r}')
+    if not isinstance(attribute[0], str) or not isinstance(attribute[1], str):
+        raise ValueError(f'{path}: attribute name and type name must be strings, got {attribute[0]!r} and {attribute[1]!r}')
+    if len(attribute) == 4:
+        name, type_name, value, is_stateful = attribute
+        # order_strict is the same as is_stateful in 4 element format
+        return [name, type_name, value, is_stateful, is_stateful]
+    if len(attribute) == 3:
+        if not isinstance(attribute[2], dict):
+            raise ValueError(f'{path}: attribute {attribute[0]} has no serialized topic')
+        if renamed:
+            # the serialized topic embeds the topic name, which contains the old id
+            name, type_name, serialized = attribute
+            info = Topic.get_info(serialized)
+            return [name, type_name, info['value'], info['stateful'], info['order_strict']]
+    return attribute
+
+def _remap_wrapped(attributes: List[List], wrapped_topics: List[str], id_map: Dict[str,str]):
+    # the same rules as SObjectSerialized.update_references
+    for attr in attributes:
+        name, value = attr[0], attr[2]
+        if name in wrapped_topics:
+            if isinstance(value, str) and value in id_map:
+                attr[2] = id_map[value]
+            elif isinstance(value, list):
+                attr[2] = [id_map[id] if id in id_map else id for id in value]
+            elif isinstance(value, dict):
+                attr[2] = {key: id_map[id] if id in id_map else id for key, id in value.items()}
+
+def prepare_subtree(data: str|bytes|Dict|List, type_map: Dict[str,str]|None = None, id_map: Dict[str,str]|None = None) -> Tuple[List[Row], int]:
+    '''
+    Decode, check and normalise one input item. Runs in the worker processes.
+    Returns the node rows of all the subtrees in the item and the largest generated id count found in it.
+    '''
+    if isinstance(data, (str, bytes, bytearray)):
+        data = json.loads(data)
+    roots = data if isinstance(data, list) else [data]
+    type_map = type_map or {}
+    id_map = id_map or {}
+
+    rows : List[Row] = []
+    parents : List[int] = []
+    id_count = 0
+    # pre-order walk, children pushed in reverse so they keep their order
+    stack : List[tuple[Any,int,str]] = [(root, -1, '') for root in reversed(roots)]
+    while stack:
+        node, parent, path = stack.pop()
+        if not isinstance(node, dict):
+            raise ValueError(f'{path or "/"}: expected a serialized object, got {type(node).__name__}')
+        for key in ('id', 'type', 'attributes', 'children'):
+            if key not in node:
+                raise ValueError(f'{path or "/"}: missing key {key!r}')
+        old_id, type_name, attributes, children = node['id'], node['type'], node['attributes'], node['children']
+        path = f'{path}/{old_id}'
+        if not isinstance(old_id, str) or not isinstance(type_name, str):
+            raise ValueError(f'{path}: id and type must be strings')
+        if not isinstance(attributes, list) or not isinstance(children, dict):
+            raise ValueError(f'{path}: attributes must be a list and children a dict')
+
+        id = id_map.get(old_id, old_id)
+        user_attribute_references = node.get('user_attribute_references') or {}
+        user_sobject_references = node.get('user_sobject_references') or {}
+        wrapped_topics = node.get('wrapped_topics') or []
+        attributes = [_normalise_attribute(attribute, id != old_id, path) for attribute in attributes]
+        if id_map:
+            user_sobject_references = {name: id_map.get(ref, ref) for name, ref in user_sobject_references.items()}
+            _remap_wrapped(attributes, wrapped_topics, id_map)
+
+        match = _generated_id_pattern.fullmatch(id)
+        if match is not None:
+            id_count = max(id_count, int(match.group(1)))
+
+        index = len(rows)
+        rows.append((id, type_map.get(type_name, type_name), attributes, 1, user_attribute_references, user_sobject_references, wrapped_topics))
+        parents.append(parent)
+        for child_id, child in reversed(children.items()):
+            if isinstance(child, dict) and child.get('id') != child_id:
+                raise ValueError(f'{path}: child is stored under {child_id!r} but its id is {child.get("id")!r}')
+            stack.append((child, index, path))
+
+    # parents come before their descendants, so accumulating backwards gives the subtree sizes
+    sizes = [1] * len(rows)
+    for index in range(len(rows) - 1, -1, -1):
+        if parents[index] != -1:
+            sizes[parents[index]] += sizes[index]
+    rows = [row[:_SIZE] + (sizes[index],) + row[_SIZE+1:] for index, row in enumerate(rows)]
+    return rows, id_count
+
+def prepare_subtrees(items: Iterable[str|bytes|Dict|List], type_map: Dict[str,str]|None = None, id_map: Dict[str,str]|None = None,
+        processes: int|None = None) -> Iterator[Tuple[List[Row], int]]:
+    '''
+    Run prepare_subtree on every item, in a pool of processes, which defaults to the number of CPUs.
+    Results are yielded in the order of items. With a single item or process, no pool is started.
+    '''
+    items = list(items)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(items))
+    if processes <= 1:
+        for item in items:
+            yield prepare_subtree(item, type_map, id_map)
+        return
+    with ProcessPoolExecutor(processes) as executor:
+        # a few tasks per process balances uneven items without paying the round trip for each one
+        chunksize = max(1, len(items) // (processes * 4))
+        yield from executor.map(prepare_subtree, items, repeat(type_map), repeat(id_map), chunksize=chunksize)
+
+def _child_rows(rows: List[Row], index: int) -> Iterator[int]:
+    child = index + 1
+    end = index + rows[index][_SIZE]
+    while child < end:
+        yield child
+        child += rows[child][_SIZE]
+
+def _read_row(rows: List[Row], index: int) -> SObjectSerialized:
+    id, type, attributes, _, user_attribute_references, user_sobject_references, wrapped_topics = rows[index]
+    return SObjectSerialized(id, type, attributes, _RowChildren(rows, index), user_attribute_references, user_sobject_references, wrapped_topics) # type: ignore
+
+class _RowChildren(Mapping):
+    '''
+    Maps child id to SObjectSerialized, creating the children from the rows only when accessed.
+    '''
+    def __init__(self, rows: List[Row], index: int):
+        self._rows = rows
+        self._index = index
+        self._children : Dict[str,int]|None = None
+
+    def _get_children(self) -> Dict[str,int]:
+        if self._children is None:
+            self._children = {self._rows[child][_ID]: child for child in _child_rows(self._rows, self._index)}
+        return self._children
+
+    def __getitem__(self, id: str) -> SObjectSerialized:
+        return _read_row(self._rows, self._get_children()[id])
+
+    def __iter__(self):
+        return iter(self._get_children())
+
+    def __len__(self):
+        return len(self._get_children())
+
+    def values(self) -> List[SObjectSerialized]: # type: ignore
+        return [_read_row(self._rows, child) for child in _child_rows(self._rows, self._index)]
+
+def import_subtrees(server: Server, items: Iterable[str|bytes|Dict|List], parent_id: str = 'root', type_map: Dict[str,str]|None = None,
+        id_map: Dict[str,str]|None = None, processes: int|None = None) -> List[SObject]:
+    '''
+    Prepare the items in a process pool, then create their objects under parent_id as one undoable step.
+    Nothing is created if any item is malformed, uses an unregistered type, or has an id that is already taken.
+    '''
+    roots : List[SObjectSerialized] = []
+    seen = set()
+    id_count = 0
+    for rows, rows_id_count in prepare_subtrees(items, type_map, id_map, processes):
+        for row in rows:
+            if row[_TYPE] not in server._object_types:
+                raise ValueError(f'Unknown object type {row[_TYPE]} of {row[_ID]}')
+            if row[_ID] in seen or server.has_object(row[_ID]):
+                raise ValueError(f'Object id {row[_ID]} is already taken')
+            seen.add(row[_ID])
+        index = 0
+        while index < len(rows):
+            roots.append(_read_row(rows, index))
+            index += rows[index][_SIZE]
+        id_count = max(id_count, rows_id_count)
+
+    # keep generated ids from colliding with the imported ones
+    if id_count > server.get_id_count():
+        server.set_id_count(id_count)
+    return server.create_objects([{'type': root.type, 'parent_id': parent_id, 'serialized': root} for root in roots])
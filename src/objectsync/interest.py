@@ -0,0 +1,221 @@
+'''
+Per-client interest management.
+
+By default every client subscribes to _objects, which lists every object, and then to the topics of the objects
+it wants. A client can instead declare the ids of the subtrees it is interested in, with the set_interest service
+or Server.set_client_interest. It then gets its own view topic, _objects/client/<client id>, listing only
+
+    - the objects in the subtrees of its roots
+    - the ancestors of its roots, so the client can place the subtrees in the hierarchy
+
+The view follows creation, destruction and reparenting, including by undo and redo. The server ignores the
+client's subscriptions to the topics of objects outside the view, and to _objects or its shards, and unsubscribes it from the
+topics of objects that leave the view. The topic list of topicsync is still global.
+'''
+from __future__ import annotations
+import logging
+from typing import TYPE_CHECKING, Dict, Iterable, List, Set
+
+from topicsync.topic import DictTopic
+
+from objectsync.sobject import SObject
+
+if TYPE_CHECKING:
+    from objectsync.server import Server
+
+logger = logging.getLogger(__name__)
+
+VIEW_PREFIX = '_objects/client/'
+SHARD_PREFIX = '_objects/shard/'
+
+class ClientInterest:
+    __slots__ = ('client_id', 'roots', 'path', 'visible', 'view')
+    def __init__(self, client_id: int, roots: Set[str], view: DictTopic) -> None:
+        self.client_id = client_id
+        self.roots = roots
+        self.path : Set[str] = set()
+        ''' The ids of the ancestors of the roots '''
+        self.visible : Dict[str,str] = {}
+        ''' Mirrors the value of view: id -> frontend type '''
+        self.view = view
+
+    def covers(self, obj: SObject|None) -> bool:
+        ''' Whether obj is in the subtree of a root '''
+        roots = self.roots
+        while obj is not None:
+            if obj._id in roots:
+                return True
+            obj = obj._parent
+        return False
+
+class InterestManager:
+    def __init__(self, server: Server) -> None:
+        self._server = server
+        self._interests : Dict[int,ClientInterest] = {}
+        client_manager = server._topicsync._client_manager
+        self._subscribe = client_manager._handle_subscribe
+        client_manager.register_message_handler('subscribe', self._handle_subscribe)
+        server.on_client_disconnect += self._on_client_disconnect
+
+    def __bool__(self) -> bool:
+        return len(self._interests) > 0
+
+    def set_interest(self, client_id: int, roots: Iterable[str]|None) -> str|None:
+        '''
+        Restrict the client to the subtrees of roots, or lift the restriction if roots is None.
+        Returns the name of the view topic the client should subscribe to instead of _objects.
+        '''
+        interest = self._interests.get(client_id)
+        if roots is None:
+            if interest is not None:
+                del self._interests[client_id]
+                with self._server._untracked():
+                    self._server.remove_topic(interest.view.get_name())
+            return None
+
+        if interest is None:
+            view = self._server._create_untracked_topic(f'{VIEW_PREFIX}{client_id}', DictTopic, {}, is_stateful=False)
+            interest = self._interests[client_id] = ClientInterest(client_id, set(roots), view)
+            # it has to use the view from now on
+            for topic_name, subscribers in self._subscriptions().items():
+                if topic_name == '_objects' or topic_name.startswith(SHARD_PREFIX):
+                    subscribers.discard(client_id)
+        else:
+            interest.roots = set(roots)
+        self._refresh(interest)
+        return interest.view.get_name()
+
+    def get_interest(self, client_id: int) -> Set[str]|None:
+        interest = self._interests.get(client_id)
+        return None if interest is None else set(interest.roots)
+
+    def _subscriptions(self) -> Dict[str,Set[int]]:
+        return self._server._topicsync._client_manager._subscriptions
+
+    def _handle_subscribe(self, sender, topic_name: str):
+        interest = self._interests.get(sender.id)
+        if interest is not None:
+            if topic_name == '_objects' or topic_name.startswith(SHARD_PREFIX) or (topic_name.startswith(VIEW_PREFIX) and topic_name != interest.view.get_name()):
+                return
+            owner = self._server._topic_owners.get(topic_name)
+            if owner is not None and owner._id not in interest.visible:
+                logger.debug(f'Client {sender.id} is not interested in {topic_name}')
+                return
+        self._subscribe(sender=sender, topic_name=topic_name)
+
+    def _on_client_disconnect(self, client_id: int):
+        self.set_interest(client_id, None)
+
+    '''
+    Keeping the views up to date
+    '''
+
+    def objects_changed(self, changes: Dict[str,str|None]):
+        '''
+        Called with the updates made to _objects: id -> frontend type, or None for a removed object.
+        '''
+        objects = self._server._objects
+        for interest in self._interests.values():
+            updates : Dict[str,str|None] = {}
+            path_changed = False
+            for id, frontend_type in changes.items():
+                if frontend_type is None:
+                    if id in interest.visible:
+                        updates[id] = None
+                    path_changed = path_changed or id in interest.roots or id in interest.path
+                else:
+                    if interest.covers(objects.get(id)):
+                        updates[id] = frontend_type
+                    path_changed = path_changed or id in interest.roots
+            if path_changed:
+                self._update_path(interest, updates)
+            self._apply(interest, updates)
+
+    def reparented(self, obj: SObject):
+        '''
+        Called after obj moved to another parent, with its subtree.
+        '''
+        for interest in self._interests.values():
+            updates : Dict[str,str|None] = {}
+            stack = [(obj, interest.covers(obj))]
+            while stack:
+                node, covered = stack.pop()
+                if covered or node._id in interest.path:
+                    if node._id not in interest.visible:
+                        updates[node._id] = node.frontend_type
+                elif node._id in interest.visible:
+                    updates[node._id] = None
+                stack.extend((child, covered or child._id in interest.roots) for child in node._children.values())
+            self._update_path(interest, updates)
+            self._apply(interest, updates)
+
+    def _refresh(self, interest: ClientInterest):
+        ''' Recompute the whole view, after the roots changed '''
+        visible : Dict[str,str] = {}
+        objects = self._server._objects
+        for root in interest.roots:
+            obj = objects.get(root)
+            if obj is None or interest.covers(obj._parent):
+                continue # not created yet, or already inside another root's subtree
+            for node in obj.traverse(type=SObject):
+                visible[node._id] = node.frontend_type
+        updates : Dict[str,str|None] = {id: None for id in interest.visible if id not in visible}
+        updates.update((id, frontend_type) for id, frontend_type in visible.items() if id not in interest.visible)
+        interest.path = set()
+        self._update_path(interest, updates)
+        self._apply(interest, updates)
+
+    def _update_path(self, interest: ClientInterest, updates: Dict[str,str|None]):
+        objects = self._server._objects
+        path : Set[str] = set()
+        for root in interest.roots:
+            obj = objects.get(root)
+            if obj is None:
+                continue
+            obj = obj._parent
+            while obj is not None and obj._id not in path:
+                path.add(obj._id)
+                obj = obj._parent
+        for id in interest.path - path:
+            if updates.get(id, interest.visible.get(id)) is not None and not interest.covers(objects.get(id)):
+                updates[id] = None
+        for id in path - interest.path:
+            if id not in interest.visible or updates.get(id, '') is None:
+                updates[id] = objects[id].frontend_type
+        interest.path = path
+
+    def _apply(self, interest: ClientInterest, updates: Dict[str,str|None]):
+        visible = interest.visible
+        # drop the updates that change nothing
+        updates = {id: frontend_type for id, frontend_type in updates.items() if visible.get(id) != frontend_type}
+        if len(updates) == 0:
+            return
+        objects = self._server._objects
+        for id, frontend_type in updates.items():
+            if frontend_type is None:
+                del visible[id]
+                obj = objects.get(id)
+                if obj is not None and not obj.is_destroyed():
+                    self._unsubscribe(interest.client_id, obj)
+            else:
+                visible[id] = frontend_type
+        with self._server._untracked():
+            if len(updates) == 1:
+                (id, frontend_type), = updates.items()
+                if frontend_type is None:
+                    interest.view.pop(id)
+                else:
+                    interest.view.add(id, frontend_type)
+            else:
+                interest.view.set(dict(visible))
+
+    def _unsubscribe(self, client_id: int, obj: SObject):
+        subscriptions = self._subscriptions()
+        topic_names : List[str] = [obj._parent_id.get_name()]
+        if obj._tags is not None:
+            topic_names.append(obj._tags.get_name())
+        topic_names.extend(attr.get_name() for attr in obj._attributes.values())
+        for topic_name in topic_names:
+            subscribers = subscriptions.get(topic_name)
+            if subscribers is not None:
+                subscribers.discard(client_id)
@@ -0,0 +1,238 @@
+'''
+Append-only journal of committed transitions, for crash recovery.
+
+A journal directory holds a snapshot written by objectsync.snapshot and a file named journal,
+which records in JSON lines what happened after the snapshot was taken:
+
+    {"snapshot": name, "seq": n}                         header, names the snapshot the records apply to
+    {"seq": n, "ids": id count, "changes": [...]}        a transition
+    {"seq": n, "base": true, "changes": [...]}           a transition already contained in the snapshot.
+                                                         It is not applied, but undo and redo records can refer to it.
+    {"undo": n, "ids": id count}                         undo of transition n
+    {"redo": n, "ids": id count}                         redo of transition n
+
+Transitions are replayed the way redo applies them: listeners in auto mode are not notified, because the changes
+they made were recorded in the transition too. Creation events carry the serialized state of the new objects,
+so replaying them does not depend on build() producing the same ids again.
+
+Compaction writes a new snapshot and a new journal whose header names it, then swaps the journal in with a rename,
+so a crash at any point leaves a consistent pair on disk.
+'''
+from __future__ import annotations
+import json
+import logging
+import os
+from typing import TYPE_CHECKING, Any, Dict, List
+from weakref import WeakKeyDictionary
+
+from topicsync import Transition
+from topicsync.change import Change, EventChangeTypes
+
+from objectsync import snapshot
+from objectsync.sobject import SObjectSerialized
+
+if TYPE_CHECKING:
+    from objectsync.server import Server
+
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICIES = ('always', 'batch', 'never')
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, SObjectSerialized):
+        return {'__sobject__': value.to_dict()}
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def _decode(d: Dict[str,Any]) -> Any:
+    if len(d) == 1 and '__sobject__' in d:
+        return SObjectSerialized.from_dict(d['__sobject__'])
+    return d
+
+def _serialize_change(change: Change) -> Dict[str,Any]:
+    serialized = change.serialize()
+    # EmitChange.serialize leaves out forward_info, but undo and redo of create/destroy events need it
+    if isinstance(change, EventChangeTypes.EmitChange) and change.forward_info:
+        serialized['forward_info'] = change.forward_info
+    return serialized
+
+def _fsync_directory(directory: str):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return # directories can't be opened on some platforms
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class Journal:
+    '''
+    Appends the server's transitions, undos and redos to a journal file in directory.
+
+    fsync policies:
+        - always: write and fsync every record before the transition callback returns
+        - batch: write and fsync once batch_size records are pending, or on flush()
+        - never: write every record and leave flushing to the OS
+
+    After compact_every records, the journal is compacted into a snapshot. Pass None to only compact on open.
+    '''
+    def __init__(self, server: Server, directory: str, fsync: str = 'batch', batch_size: int = 64, compact_every: int|None = 10000) -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f'Unknown fsync policy {fsync}. Expected one of {FSYNC_POLICIES}')
+        self._server = server
+        self._directory = directory
+        self._path = os.path.join(directory, 'journal')
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.compact_every = compact_every
+        self._file = None
+        self._pending : List[str] = []
+        self._records = 0 # records since the last compaction
+        self._next_seq = 0
+        self._generation = 0
+        self._seqs : WeakKeyDictionary[Transition,int] = WeakKeyDictionary()
+
+    def open(self):
+        '''
+        Restore the state saved in the directory, if any, then compact it and start appending.
+        '''
+        os.makedirs(self._directory, exist_ok=True)
+        if os.path.exists(self._path):
+            self._recover()
+        self.compact()
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _recover(self):
+        server = self._server
+        with open(self._path, encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            self._generation = int(header['snapshot'].rsplit('.', 1)[1])
+            snapshot.load_snapshot(server, os.path.join(self._directory, header['snapshot']))
+            self._next_seq = header['seq']
+
+            transitions : Dict[int,Transition] = {}
+            id_count = server.get_id_count()
+            replayed = 0
+            for line in f:
+                try:
+                    record = json.loads(line, object_hook=_decode)
+                except json.JSONDecodeError:
+                    # a record torn by a crash in the middle of an append, nothing after it was written
+                    logger.warning(f'Ignoring a truncated record at the end of {self._path}')
+                    break
+                if 'changes' in record:
+                    transition = Transition([Change.deserialize(change) for change in record['changes']], 0)
+                    transitions[record['seq']] = transition
+                    self._next_seq = max(self._next_seq, record['seq'] + 1)
+                    if record.get('base'):
+                        continue
+                    server._topicsync.redo(transition)
+                elif 'undo' in record:
+                    server._topicsync.undo(transitions[record['undo']])
+                else:
+                    server._topicsync.redo(transitions[record['redo']])
+                id_count = max(id_count, record['ids'])
+                replayed += 1
+        if id_count > server.get_id_count():
+            server.set_id_count(id_count)
+        logger.info(f'Recovered {replayed} journal records from {self._directory}')
+
+    def compact(self):
+        '''
+        Write the current state to a new snapshot and start a new journal after it.
+        Transitions still in the history are kept as base records so they can be undone after recovery.
+        '''
+        self._pending.clear()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        generation = self._generation + 1
+        snapshot_name = f'snapshot.{generation}'
+        snapshot.save_snapshot(self._server, os.path.join(self._directory, snapshot_name))
+
+        lines = []
+        log = self._server._transition_log
+        for index in range(log.first_index(), log.end_index()):
+            item = log[index]
+            if item is None:
+                continue
+            transition = item.transition
+            seq = self._seqs.get(transition)
+            if seq is None:
+                seq = self._seqs[transition] = self._next_seq
+                self._next_seq += 1
+            try:
+                lines.append(json.dumps({'seq':seq,'base':True,'changes':[_serialize_change(change) for change in transition.changes]}, default=_encode))
+            except (TypeError, ValueError):
+                # It can't be undone after a recovery. Undoing it now triggers another compaction.
+                del self._seqs[transition]
+        lines.insert(0, json.dumps({'snapshot':snapshot_name,'seq':self._next_seq}))
+
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._path)
+        _fsync_directory(self._directory)
+
+        old_snapshot = os.path.join(self._directory, f'snapshot.{self._generation}')
+        if os.path.exists(old_snapshot):
+            os.remove(old_snapshot)
+        self._generation = generation
+        self._records = 0
+        self._file = open(self._path, 'a', encoding='utf-8')
+
+    def record_transition(self, transition: Transition):
+        seq = self._next_seq
+        self._next_seq += 1
+        try:
+            line = json.dumps({'seq':seq,'ids':self._server.get_id_count(),'changes':[_serialize_change(change) for change in transition.changes]}, default=_encode)
+        except (TypeError, ValueError) as e:
+            logger.warning(f'Transition can not be written to the journal ({e}). Compacting instead.')
+            self.compact()
+            return
+        self._seqs[transition] = seq
+        self._append(line)
+
+    def record_undo(self, transition: Transition):
+        self._record_reference('undo', transition)
+
+    def record_redo(self, transition: Transition):
+        self._record_reference('redo', transition)
+
+    def _record_reference(self, kind: str, transition: Transition):
+        seq = self._seqs.get(transition)
+        if seq is None:
+            # the transition was never journaled, so the only way to keep the journal in sync is a new snapshot
+            self.compact()
+            return
+        self._append(json.dumps({kind:seq,'ids':self._server.get_id_count()}))
+
+    def _append(self, line: str):
+        self._pending.append(line)
+        self._records += 1
+        if self.compact_every is not None and self._records >= self.compact_every:
+            self.compact()
+        elif self.fsync != 'batch' or len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the pending records. Unless the policy is never, also fsync them.
+        '''
+        if self._file is None or len(self._pending) == 0:
+            return
+        self._file.write('\n'.join(self._pending) + '\n')
+        self._pending.clear()
+        self._file.flush()
+        if self.fsync != 'never':
+            os.fsync(self._file.fileno())
@@ -0,0 +1,92 @@
+from __future__ import annotations
+import hashlib
+import json
+import weakref
+from typing import Any, Dict, List, Tuple
+
+from objectsync.sobject import SObjectSerialized
+
+def _digest(value: Any) -> bytes:
+    return hashlib.blake2b(json.dumps(value, separators=(',', ':')).encode('utf-8'), digest_size=16).digest()
+
+class SerializedPool:
+    '''
+    Hash-consing table for the SObjectSerialized payloads kept by the history.
+
+    Destroying an object serializes its whole subtree, and the transition keeps the result for undo. The server
+    interns the payloads once the history keeps them, so destroys that aren't recorded don't pay for hashing.
+    Interning the nodes bottom-up makes an unchanged subtree resolve to the node already held by an earlier
+    history entry, and an unchanged attribute resolve to the attribute already held by an earlier node,
+    so deleting and undoing the same group many times retains only what changed in between.
+
+    Interned nodes are marked shared and must be treated as immutable. Restoring from them copies the values.
+    Nodes are held weakly, attributes are released when the last node using them is collected.
+    '''
+    def __init__(self) -> None:
+        self._nodes : weakref.WeakValueDictionary[Tuple, SObjectSerialized] = weakref.WeakValueDictionary()
+        self._attributes : Dict[bytes, List] = {}
+        self._attribute_refs : Dict[bytes, int] = {}
+
+    def intern(self, node: SObjectSerialized) -> SObjectSerialized:
+        '''
+        Returns the shared node equal to node. node's children must have been interned already.
+        '''
+        try:
+            digests = [_digest(attribute) for attribute in node.attributes]
+        except (TypeError, ValueError):
+            return node # not JSON serializable, can't be compared cheaply
+
+        key = (
+            node.id,
+            node.type,
+            tuple(digests),
+            # children are interned, so identity means equality
+            tuple((child_id, id(child)) for child_id, child in node.children.items()),
+            tuple(node.user_attribute_references.items()),
+            tuple(node.user_sobject_references.items()),
+            tuple(node.wrapped_topics),
+        )
+        existing = self._nodes.get(key)
+        if existing is not None:
+            return existing
+
+        held = []
+        for i, digest in enumerate(digests):
+            attribute = self._attributes.get(digest)
+            if attribute is None:
+                self._attributes[digest] = node.attributes[i]
+                self._attribute_refs[digest] = 1
+                held.append(digest)
+            elif attribute == node.attributes[i]:
+                node.attributes[i] = attribute
+                self._attribute_refs[digest] += 1
+                held.append(digest)
+        node.shared = True
+        self._nodes[key] = node
+        weakref.finalize(node, self._release, held)
+        return node
+
+    def intern_tree(self, node: Any) -> Any:
+        '''
+        Intern a serialized subtree bottom-up. Anything that isn't a plain SObjectSerialized tree is returned as is.
+        '''
+        if not isinstance(node, SObjectSerialized) or node.shared:
+            return node
+        children = node.children
+        if not isinstance(children, dict):
+            return node # lazily read children, e.g. of an import
+        for child_id, child in children.items():
+            children[child_id] = self.intern_tree(child)
+        return self.intern(node)
+
+    def _release(self, digests: List[bytes]):
+        for digest in digests:
+            refs = self._attribute_refs[digest] - 1
+            if refs == 0:
+                del self._attribute_refs[digest]
+                del self._attributes[digest]
+            else:
+                self._attribute_refs[digest] = refs
+
+    def __len__(self) -> int:
+        return len(self._nodes)
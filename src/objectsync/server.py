@@ -1,27 +1,99 @@
+import json
 import logging
+import zlib
+from contextlib import contextmanager
 
 from objectsync.utils import NameSpace
 import topicsync
 logger = logging.getLogger(__name__)
-from typing import Dict, List, TypeVar, Any, Callable
+from typing import IO, Dict, Iterable, List, TypeVar, Any, Callable
 from topicsync import TopicsyncServer, Transition
 from topicsync.topic import Topic, IntTopic, SetTopic, DictTopic
-from topicsync.change import EventChangeTypes, StringChangeTypes
+from topicsync.change import Change, EventChangeTypes, StringChangeTypes
 
-from objectsync.hierarchy_utils import get_ancestors, lowest_common_ancestor
+from objectsync.hierarchy_utils import lowest_common_ancestor
+from objectsync.history import TransitionLog
 from objectsync.count import gen_id, get_id_count, set_id_count
-from objectsync.sobject import SObject, SObjectSerialized
+from objectsync.sobject import SObject, SObjectSerialized, _get_attribute_schema
+from objectsync import importer, snapshot, stream
+from objectsync.journal import Journal
+from objectsync.serialized_pool import SerializedPool
+from objectsync.interest import InterestManager
+from objectsync.coalesce import coalesce
+from objectsync.stats import Stats
+
+def registry_shard(id:str, n_shards:int) -> int:
+    '''
+    The index of the registry shard listing the object id. Clients compute it the same way: CRC-32 of the utf-8 id.
+    '''
+    return zlib.crc32(id.encode('utf-8')) % n_shards
 
 class Server:
     def __init__(self, root_object_type:type[SObject]=SObject, 
-                 deserialize_sort_key:Callable[[SObjectSerialized],int]=lambda x:0) -> None:
+                 deserialize_sort_key:Callable[[SObjectSerialized],int]=lambda x:0,
+                 history_max_len:int=1000, history_max_bytes:int|None=None, lean:bool=False, registry_shards:int|None=None,
+                 coalesce_changes:bool=False, history_merge_window:float|None=None, instrument:bool=False,
+                 history_max_items:int|None=None, port:int=8765, host:str='localhost') -> None:
+        '''
+        Clients connect to host:port once serve() runs; nothing is bound before that.
+
+        Each object can undo at most history_max_len of the transitions recorded in its subtree. history_max_bytes
+        bounds the estimated size of the transitions kept for undo, and history_max_items their number across
+        the whole server, both by dropping the oldest ones first. See objectsync.history.TransitionLog.
+
+        In lean mode, the tags topic of an object is created when a tag is first added, instead of with the object.
+        Clients only see the tags of objects that have been tagged on the server.
+
+        By default, the id and frontend type of every object is listed in the _objects topic. With registry_shards,
+        they are split into that many topics, _objects/shard/<i>, where i is registry_shard(id, registry_shards),
+        and _objects/shard_count holds the number of shards. A change only copies and sends its own shard.
+
+        With coalesce_changes, successive changes on the same topic in a transition are folded into their net effect
+        before the transition is stored, and before server-made changes are sent to clients. See objectsync.coalesce.
+        It can be switched with the coalesce_changes attribute. eliminated_changes counts the changes it removed.
+
+        With history_merge_window, consecutive transitions on the same topics of the same object within that many
+        seconds are merged into one undo step, e.g. the transitions of a drag. Clients still receive every change.
+        See objectsync.history.TransitionLog.
+
+        With instrument, the time spent in each phase of the object lifecycle is measured per object type, and can
+        be read with stats(). It can be switched with set_instrumentation. See objectsync.stats.
+        '''
+        self.lean = lean
+        self.coalesce_changes = coalesce_changes
+        self.eliminated_changes = 0
+        '''Number of changes removed by coalescing, from transitions and from updates sent to clients'''
         self._to_clear_history = False
-        self._topicsync = TopicsyncServer(transition_callback=self._transition_callback)
+        self._stats : Stats|None = Stats() if instrument else None
+        self._topicsync = TopicsyncServer(port, host, transition_callback=self._transition_callback)
         self._objects : Dict[str,SObject] = {}
+        self._topic_owners : Dict[str,SObject] = {}
+        '''Maps the name of each parent_id, tags and attribute topic to the SObject that owns it'''
+        self._transition_log = TransitionLog(history_max_len, history_max_bytes, history_merge_window, history_max_items)
+        self._objects_by_type : Dict[str,Dict[str,SObject]] = {}
+        self._objects_by_tag : Dict[Any,Dict[str,SObject]] = {}
+        self._objects_topic_batch : Dict[str,str|None]|None = None
+        '''Pending _objects_topic updates while in _batch_objects_topic, None marks a removal'''
+        self._topics_to_remove : List[str]|None = None
+        '''Pending topic removals while in _batch_remove_topics'''
+        self._serialized_pool = SerializedPool()
+        '''Shares identical subtrees and attributes between the payloads of destroy transitions'''
+        self._journal : Journal|None = None
+        self._prototypes : Dict[tuple,SObjectSerialized] = {}
+        '''Serialized first instance of each (type name, build_kwargs), see create_object_from_prototype'''
+        self._building = False
+        '''True while a top level _create_object builds its object, so the objects created by build() are not serialized for the journal'''
         root_id = 'root'
         self._root_object = root_object_type(self,root_id,'')
         self._objects[root_id] = self._root_object
-        self._objects_topic = self.create_topic('_objects',DictTopic,{root_id:'Root'})
+        self._objects_topic : DictTopic|None = None
+        self._registry_shards : List[DictTopic]|None = None
+        if registry_shards is None:
+            self._objects_topic = self.create_topic('_objects',DictTopic,{root_id:'Root'})
+        else:
+            self.create_topic('_objects/shard_count',IntTopic,registry_shards)
+            self._registry_shards = [self.create_topic(f'_objects/shard/{i}',DictTopic,{root_id:'Root'} if i == registry_shard(root_id, registry_shards) else {})
+                for i in range(registry_shards)]
         self._object_types : Dict[str,type[SObject]] = {}
         self._object_types_to_names : Dict[type[SObject],str] = {SObject:'SObject'}
 
@@ -29,6 +101,7 @@ class Server:
         # so these methods can be called from both client and server
         self._topicsync.on('create_object', self._create_object, self._destroy_object)
         self._topicsync.on('destroy_object', self._destroy_object, self._create_object)
+        self._topicsync.on('create_objects', self._create_objects, self._destroy_objects)
 
         self._topicsync.register_service('undo', self._undo)
         self._topicsync.register_service('redo', self._redo)
@@ -47,6 +120,20 @@ class Server:
         self.get_action_source = self._topicsync.get_action_source
 
         self.globals = NameSpace()
+
+        state_machine = self._topicsync._state_machine
+        send_changes = state_machine._changes_callback
+        def changes_callback(changes, action_id):
+            # changes of client actions keep their ids, the client uses them to confirm its own changes
+            if self.coalesce_changes and action_id == '':
+                changes, eliminated = coalesce(changes)
+                self.eliminated_changes += eliminated
+            send_changes(changes, action_id)
+        state_machine._changes_callback = changes_callback
+
+        self._interest = InterestManager(self)
+        '''Per-client subtree views, see objectsync.interest'''
+        self._topicsync.register_service('set_interest', self._set_interest_service, pass_sender=True)
         
     async def serve(self):
         '''
@@ -62,6 +149,11 @@ class Server:
         '''
         This method is "raw" create object. It does not record the creation in a transition.
         To create an object and record the creation in a transition, use create_object or create_object_s.
+
+        The serialized state needed to redo the creation is not produced here. Undoing calls _destroy_object,
+        whose returned serialized state is merged into the event's forward info and used by the redo.
+        The exception is when a journal is open: the journal replays creations from the serialized state,
+        so it is returned right after the object is built.
         '''
         logger.debug(f'create object: {type} {id}')
         if id is None:
@@ -69,18 +161,58 @@ class Server:
         cls = self._object_types[type]
         new_object = cls(self,id,parent_id)
         self._objects[id] = new_object
-        new_object.initialize(serialized,build_kwargs=build_kwargs,call_init=False)
-        temp = new_object.serialize()
+        objects_of_type = self._objects_by_type.get(type)
+        if objects_of_type is None:
+            objects_of_type = self._objects_by_type[type] = {}
+        objects_of_type[id] = new_object
+        capture = serialized is None and self._journal is not None and not self._building
+        if capture:
+            self._building = True
+            try:
+                new_object.initialize(serialized,build_kwargs=build_kwargs,call_init=False)
+            finally:
+                self._building = False
+            serialized = new_object.serialize()
+        else:
+            new_object.initialize(serialized,build_kwargs=build_kwargs,call_init=False)
         new_object.get_parent()._add_child(new_object)
         assert new_object.get_parent().get_id() == parent_id
-        self._objects_topic.add(id,cls.frontend_type)
-        new_object.init()
-        return {'id':id,'type':type,'parent_id':parent_id,'serialized':temp}
+        if self._objects_topic_batch is not None:
+            self._objects_topic_batch[id] = cls.frontend_type
+        else:
+            self._registry_topic(id).add(id,cls.frontend_type)
+            if self._interest:
+                self._interest.objects_changed({id:cls.frontend_type})
+        if self._stats is None:
+            new_object.init()
+        else:
+            self._stats.call('init', type, new_object.init)
+        if capture:
+            return {'id':id,'type':type,'parent_id':parent_id,'serialized':serialized}
+        return {'id':id,'type':type,'parent_id':parent_id}
     
     def _destroy_object(self, id, **kwargs):
-        self._objects_topic.pop(id)
+        '''
+        Destroy the object and its subtree. The topics and _objects entries of the whole subtree are
+        collected while it is destroyed and removed together at the end.
+        '''
+        with self._batch_objects_topic(), self._batch_remove_topics():
+            return self._destroy_object_raw(id)
+
+    def _destroy_object_raw(self, id):
+        if self._objects_topic_batch is not None:
+            self._objects_topic_batch[id] = None
+        else:
+            self._registry_topic(id).pop(id)
+            if self._interest:
+                self._interest.objects_changed({id:None})
         obj = self._objects[id]
-        serialized = obj.destroy()
+        if obj._history is not None:
+            self._transition_log._release(obj._history)
+        if self._stats is None:
+            serialized = obj.destroy()
+        else:
+            serialized = self._stats.call('destroy', self._stats_type_name(obj), obj.destroy)
 
         # Normally, obj should be in the parent's children list, but if the _destroy_object is called due to 
         # a failure in obj.initialize (which is called in _create_object), then the parent will not have the child.
@@ -89,7 +221,93 @@ class Server:
             obj.get_parent()._remove_child(obj)
 
         del self._objects[id]
-        return {'type':self._object_types_to_names[obj.__class__],'parent_id':obj.get_parent().get_id(),'serialized':serialized}
+        type_name = self._object_types_to_names[obj.__class__]
+        objects_of_type = self._objects_by_type[type_name]
+        del objects_of_type[id]
+        if len(objects_of_type) == 0:
+            del self._objects_by_type[type_name]
+        return {'type':type_name,'parent_id':obj.get_parent().get_id(),'serialized':serialized}
+
+    def _create_objects(self, objects:List[Dict[str,Any]], serialized_objects:List[SObjectSerialized]|None=None, **kwargs):
+        '''
+        Raw bulk create. Creates the objects in order, so an object can be the parent of later ones.
+        When redoing, serialized_objects holds the state of each object returned by _destroy_objects on undo.
+        '''
+        created = []
+        with self._batch_objects_topic():
+            for i, spec in enumerate(objects):
+                serialized = spec.get('serialized') if serialized_objects is None else serialized_objects[i]
+                result = self._create_object(spec['type'], spec['parent_id'], spec['id'], serialized, spec.get('build_kwargs', {}))
+                created.append(result.get('serialized', serialized))
+        if serialized_objects is None and self._journal is not None:
+            return {'serialized_objects':created}
+
+    def _destroy_objects(self, objects:List[Dict[str,Any]], **kwargs):
+        '''
+        Raw bulk destroy, the inverse of _create_objects. Objects are destroyed in reverse order so children go before their parents.
+        '''
+        serialized_objects = []
+        with self._batch_objects_topic(), self._batch_remove_topics():
+            for spec in reversed(objects):
+                serialized_objects.append(self._destroy_object(spec['id'])['serialized'])
+        serialized_objects.reverse()
+        return {'serialized_objects':serialized_objects}
+
+    @contextmanager
+    def _batch_objects_topic(self):
+        '''
+        Collect the additions and removals made to the registry topics and apply them as one change per topic on exit.
+        '''
+        if self._objects_topic_batch is not None:
+            yield
+            return
+        batch = self._objects_topic_batch = {}
+        try:
+            yield
+        finally:
+            self._objects_topic_batch = None
+            if self._registry_shards is None:
+                self._update_registry_topic(self._objects_topic, batch, len(self._objects)) # type: ignore
+            else:
+                n_shards = len(self._registry_shards)
+                shard_batches : Dict[int,Dict[str,str|None]] = {}
+                for id, frontend_type in batch.items():
+                    shard = registry_shard(id, n_shards)
+                    shard_batch = shard_batches.get(shard)
+                    if shard_batch is None:
+                        shard_batch = shard_batches[shard] = {}
+                    shard_batch[id] = frontend_type
+                for shard, shard_batch in shard_batches.items():
+                    self._update_registry_topic(self._registry_shards[shard], shard_batch, len(self._objects) // n_shards)
+            if self._interest and len(batch):
+                self._interest.objects_changed(batch)
+
+    def _registry_topic(self, id:str) -> DictTopic:
+        '''
+        The topic listing the object id: _objects, or its shard.
+        '''
+        if self._registry_shards is None:
+            return self._objects_topic # type: ignore
+        return self._registry_shards[registry_shard(id, len(self._registry_shards))]
+
+    def _update_registry_topic(self, topic:DictTopic, updates:Dict[str,str|None], size:int):
+        # Setting the whole value copies it and sends it to every client, so only do it when the updates
+        # are a significant share of the topic. Otherwise add and pop the entries one by one.
+        if len(updates) * 8 < size or len(updates) == 1:
+            for id, frontend_type in updates.items():
+                if frontend_type is None:
+                    if id in topic:
+                        topic.pop(id)
+                else:
+                    topic.add(id, frontend_type)
+        elif len(updates) > 1:
+            value = topic.get()
+            for id, frontend_type in updates.items():
+                if frontend_type is None:
+                    value.pop(id, None)
+                else:
+                    value[id] = frontend_type
+            topic.set(value)
     
     def clear_history_inclusive(self):
         '''
@@ -101,13 +319,34 @@ class Server:
             self._to_clear_history = True
 
     def _transition_callback(self, transition:Transition):
+        if self.coalesce_changes:
+            transition.changes, eliminated = coalesce(transition.changes)
+            if eliminated:
+                self.eliminated_changes += eliminated
+                logger.debug(f'coalesced {eliminated} changes, {len(transition.changes)} left')
+            if len(transition.changes) == 0:
+                return
+        if self._stats is None:
+            self._add_to_history(transition)
+        else:
+            start = self._stats.start()
+            lowest = self._add_to_history(transition)
+            self._stats.stop('transition', '' if lowest is None else self._stats_type_name(lowest), start)
+        if self._journal is not None:
+            self._journal.record_transition(transition)
+
+    def _add_to_history(self, transition:Transition) -> SObject|None:
+        '''
+        Returns the object the transition was recorded in, None if it wasn't recorded.
+        '''
         # Find the lowest object to record the transition in
 
-        debug_msg = '\n=== tran ==='
-        for change in transition.changes:
-            debug_msg += '\n' + str(change.serialize())
-        debug_msg += '\n'
-        logger.debug(debug_msg)
+        if logger.isEnabledFor(logging.DEBUG):
+            debug_msg = '\n=== tran ==='
+            for change in transition.changes:
+                debug_msg += '\n' + str(change.serialize())
+            debug_msg += '\n'
+            logger.debug(debug_msg)
 
         if self._to_clear_history:
             self.clear_history()
@@ -115,49 +354,95 @@ class Server:
             return
         
         affected_objs = []
+        topic_owners = self._topic_owners
         for change in transition.changes:
-            split = change.topic_name.split('/')
-            match split[0]:
-                case 'create_object':
-                    assert isinstance(change, (EventChangeTypes.EmitChange))
-                    affected_objs.append(self._objects[change.args['parent_id']])
-                case 'destroy_object':
-                    assert isinstance(change, (EventChangeTypes.EmitChange))
-                    affected_objs.append(self._objects[change.forward_info['parent_id']])
-                case 'a':
-                    affected_objs.append(self._objects[split[1]])
-                case 'parent_id':
+            topic_name = change.topic_name
+            owner = topic_owners.get(topic_name)
+            if owner is not None:
+                if owner._parent_id.get_name() == topic_name:
                     assert isinstance(change, (StringChangeTypes.SetChange))
                     assert change.old_value is not None
                     affected_objs.append(self._objects[change.old_value])
                     affected_objs.append(self._objects[change.value])
-                case 'tags':
-                    affected_objs.append(self._objects[change.topic_name.split('/')[1]]) # improve this
+                else:
+                    affected_objs.append(owner)
+            elif topic_name == 'create_object':
+                assert isinstance(change, (EventChangeTypes.EmitChange))
+                affected_objs.append(self._objects[change.args['parent_id']])
+            elif topic_name == 'destroy_object':
+                assert isinstance(change, (EventChangeTypes.EmitChange))
+                affected_objs.append(self._objects[change.forward_info['parent_id']])
+            elif topic_name == 'create_objects':
+                assert isinstance(change, (EventChangeTypes.EmitChange))
+                created = {spec['id'] for spec in change.args['objects']}
+                for spec in change.args['objects']:
+                    if spec['parent_id'] not in created:
+                        affected_objs.append(self._objects[spec['parent_id']])
 
         if len(affected_objs) == 0:
             return
 
         lowest = lowest_common_ancestor(affected_objs)
-        for obj in get_ancestors(lowest):
-            obj.history.add(transition)
+        self._transition_log.add(transition, lowest._ancestry, self._fold_merged if self.coalesce_changes else None)
+        self._intern_payloads(transition)
+        return lowest
         
 
+    def _fold_merged(self, changes:List[Change]) -> List[Change]:
+        changes, eliminated = coalesce(changes)
+        self.eliminated_changes += eliminated
+        return changes
+
+    def _intern_payloads(self, transition:Transition):
+        '''
+        Share the serialized objects kept in the forward info of create and destroy events with the other
+        history entries, now that the history keeps them. See objectsync.serialized_pool.
+        '''
+        pool = self._serialized_pool
+        for change in transition.changes:
+            if not isinstance(change, EventChangeTypes.EmitChange) or not change.forward_info:
+                continue
+            info = change.forward_info
+            if info.get('serialized') is not None:
+                info['serialized'] = pool.intern_tree(info['serialized'])
+            if info.get('serialized_objects') is not None:
+                info['serialized_objects'] = [pool.intern_tree(serialized) for serialized in info['serialized_objects']]
+
     def _undo(self, target = None):
         if target is None:
             target = 'root'
-        transition = self._objects[target].history.undo()
+        if self._stats is not None:
+            return self._stats.call('undo', self._stats_type_name(self._objects[target]), self._undo_raw, target)
+        self._undo_raw(target)
+
+    def _undo_raw(self, target):
+        history = self._objects[target].history
+        transition = history.undo()
 
         if transition is not None:
             self._topicsync.undo(transition)
+            self._intern_payloads(transition)
+            # undoing a creation fills in the state to recreate it with, which the byte budget has to count
+            self._transition_log.remeasure(history._cursor + 1) # type: ignore
+            if self._journal is not None:
+                self._journal.record_undo(transition)
         else:
             logger.debug('no transition to undo')
 
     def _redo(self, target = None):
         if target is None:
             target = 'root'
+        if self._stats is not None:
+            return self._stats.call('redo', self._stats_type_name(self._objects[target]), self._redo_raw, target)
+        self._redo_raw(target)
+
+    def _redo_raw(self, target):
         transition = self._objects[target].history.redo()
         if transition is not None:
             self._topicsync.redo(transition)
+            self._intern_payloads(transition)
+            if self._journal is not None:
+                self._journal.record_redo(transition)
         else:
             logger.debug('no transition to redo')
 
@@ -174,6 +459,8 @@ class Server:
             raise ValueError(f'Object type {object_type} already exists')
         self._object_types[name] = object_type
         self._object_types_to_names[object_type] = name
+        # resolve the declared attributes once, so creating instances is a single pass over the schema
+        _get_attribute_schema(object_type)
 
     def unregister(self, object_type:type[SObject]|str):
         
@@ -185,11 +472,14 @@ class Server:
             object_type_name = self._object_types_to_names[object_type]
 
         # check if exists object of this type
-        for obj in self._objects.values():
-            if obj.get_type_name() == object_type_name:
-                raise ValueError(f'Cannot unregister object type {self._object_types_to_names[object_type]} with existing object {obj.get_id()}')
+        objects_of_type = self._objects_by_type.get(object_type_name)
+        if objects_of_type:
+            obj = next(iter(objects_of_type.values()))
+            raise ValueError(f'Cannot unregister object type {self._object_types_to_names[object_type]} with existing object {obj.get_id()}')
         del self._object_types[object_type_name]
         del self._object_types_to_names[object_type]
+        for key in [key for key in self._prototypes if key[0] == object_type_name]:
+            del self._prototypes[key]
 
     def get_all_node_types(self)->Dict[str,type[SObject]]:
         return self._object_types.copy()
@@ -202,6 +492,32 @@ class Server:
     
     def has_object(self, id:str) -> bool:
         return id in self._objects
+
+    T = TypeVar('T', bound=SObject)
+    def get_objects_of_type(self, type:type[T]|str) -> List[T]:
+        '''
+        Returns the objects whose registered type is exactly the given type. Subclasses registered separately are not included.
+        '''
+        if not isinstance(type, str):
+            type = self._object_types_to_names[type]
+        return list(self._objects_by_type.get(type, {}).values()) # type: ignore
+
+    def get_objects_with_tag(self, tag) -> List[SObject]:
+        return list(self._objects_by_tag.get(tag, {}).values())
+
+    def _add_tag_index(self, tag, obj:SObject):
+        objects_with_tag = self._objects_by_tag.get(tag)
+        if objects_with_tag is None:
+            objects_with_tag = self._objects_by_tag[tag] = {}
+        objects_with_tag[obj.get_id()] = obj
+
+    def _remove_tag_index(self, tag, obj:SObject):
+        objects_with_tag = self._objects_by_tag.get(tag)
+        if objects_with_tag is None or objects_with_tag.get(obj.get_id()) is not obj:
+            return
+        del objects_with_tag[obj.get_id()]
+        if len(objects_with_tag) == 0:
+            del self._objects_by_tag[tag]
     
     def create_object_s(self, type:str, parent_id:str, id:str|None = None, serialized:SObjectSerialized|None=None,**build_kwargs) -> SObject:
         if id is None:
@@ -215,6 +531,70 @@ class Server:
         assert isinstance(new_object, type)
         return new_object
     
+    def create_objects(self, objects:List[Dict[str,Any]]) -> List[SObject]:
+        '''
+        Create many objects as a single change, recorded as one undoable step.
+
+        Each item of objects is a dict with keys:
+            - type: the object type or its registered name
+            - parent_id (optional): defaults to 'root'. Can be the id of an object earlier in the list
+            - id (optional): generated if not given, or the id of serialized if it is given
+            - serialized (optional): restore the object from it instead of calling build()
+            - build_kwargs (optional): keyword arguments passed to build()
+        '''
+        specs = []
+        for item in objects:
+            type = item['type']
+            specs.append({
+                'type': type if isinstance(type, str) else self._object_types_to_names[type],
+                'parent_id': item.get('parent_id', 'root'),
+                'id': item.get('id') or (item['serialized'].id if item.get('serialized') is not None else gen_id()),
+                'serialized': item.get('serialized'),
+                'build_kwargs': item.get('build_kwargs', {}),
+            })
+        self._topicsync.emit('create_objects', objects = specs)
+        return [self.get_object(spec['id']) for spec in specs]
+
+    def create_object_from_prototype(self, type:type[T], parent_id:str='root', **build_kwargs) -> T:
+        '''
+        Like create_object, but build() only runs for the first object of each type and build_kwargs.
+        That object is serialized as the prototype, and later ones are restored from a copy of it with new ids,
+        without running build() and creating the children one by one.
+
+        Only use it for types whose build() depends on nothing but build_kwargs.
+        init() still runs for every object. build_kwargs must be JSON serializable to be cached,
+        otherwise this falls back to create_object.
+        '''
+        type_name = self._object_types_to_names[type]
+        try:
+            key = (type_name, json.dumps(build_kwargs, sort_keys=True))
+        except TypeError:
+            return self.create_object(type, parent_id, **build_kwargs)
+        prototype = self._prototypes.get(key)
+        if prototype is None:
+            new_object = self.create_object(type, parent_id, **build_kwargs)
+            self._prototypes[key] = new_object.serialize()
+            return new_object
+        serialized = prototype.with_new_ids()
+        return self.create_object(type, parent_id, serialized.id, serialized)
+
+    def clear_prototypes(self):
+        '''
+        Forget the prototypes made by create_object_from_prototype, e.g. after changing what build() does.
+        '''
+        self._prototypes.clear()
+
+    def clone_object(self, id:str, parent_id:str|None=None) -> SObject:
+        '''
+        Create a copy of a live object and its subtree under parent_id, which defaults to the object's parent.
+        The copy is recorded like create_object, so it can be undone.
+        '''
+        obj = self._objects[id]
+        if parent_id is None:
+            parent_id = obj.get_parent().get_id()
+        serialized = obj.serialize_with_new_ids()
+        return self.create_object_s(serialized.type, parent_id, serialized.id, serialized)
+
     def destroy_object(self, id:str):
         self._topicsync.emit('destroy_object', id = id)
 
@@ -233,10 +613,129 @@ class Server:
     def get_root_object(self) -> SObject:
         return self._objects['root']
     
+    def save_snapshot(self, path:str):
+        '''
+        Save all objects to a compact binary file. See objectsync.snapshot for the format.
+        '''
+        snapshot.save_snapshot(self, path)
+
+    def load_snapshot(self, path:str):
+        '''
+        Restore the objects saved by save_snapshot under the root object. The restore is not undoable.
+        '''
+        snapshot.load_snapshot(self, path)
+        if self._journal is not None:
+            # the restore can't be replayed from the journal, so start a new one after it
+            self._journal.compact()
+
+    def save_stream(self, file:IO[str], id:str|None=None):
+        '''
+        Write the subtree of object id, or the children of the root object if id is None or 'root', to file as JSON lines.
+        Unlike serialize, this doesn't hold the serialized tree in memory. See objectsync.stream for the format.
+        '''
+        root = self.get_root_object()
+        top = list(root.get_children()) if id is None or id == root.get_id() else [self._objects[id]]
+        stream.save_stream(self, file, top)
+
+    def load_stream(self, lines:Iterable[str|bytes], parent_id:str='root') -> List[SObject]:
+        '''
+        Create the objects written by save_stream under parent_id while reading them. The restore is not undoable.
+        '''
+        created = stream.load_stream(self, lines, parent_id)
+        if self._journal is not None:
+            # the restore can't be replayed from the journal, so start a new one after it
+            self._journal.compact()
+        return created
+
+    def import_subtrees(self, items:Iterable[str|bytes|Dict|List], parent_id:str='root', type_map:Dict[str,str]|None=None,
+            id_map:Dict[str,str]|None=None, processes:int|None=None) -> List[SObject]:
+        '''
+        Import serialized objects under parent_id as one undoable step. Each item is the JSON text of a serialized object,
+        or of a list of them. Items are decoded, checked and normalised in a process pool, see objectsync.importer.
+        type_map renames object types and id_map renames object ids, updating the references to them.
+        '''
+        return importer.import_subtrees(self, items, parent_id, type_map, id_map, processes)
+
+    def set_client_interest(self, client_id:int, roots:List[str]|None) -> str|None:
+        '''
+        Only sync the subtrees of roots, and their ancestors, to the client. Pass None to sync everything again.
+        Returns the name of the topic listing the client's objects, which it should use instead of _objects.
+        Clients can also call the set_interest service with roots. See objectsync.interest.
+        '''
+        return self._interest.set_interest(client_id, roots)
+
+    def get_client_interest(self, client_id:int) -> set[str]|None:
+        return self._interest.get_interest(client_id)
+
+    def _set_interest_service(self, roots:List[str]|None, sender:int):
+        return self._interest.set_interest(sender, roots)
+
+    def open_journal(self, directory:str, fsync:str='batch', batch_size:int=64, compact_every:int|None=10000):
+        '''
+        Persist every change to a journal in directory, so the state survives a crash.
+        If the directory already holds a journal, its state is restored first, so call this before creating any object.
+        See objectsync.journal.Journal for the fsync policies.
+        '''
+        if self._journal is not None:
+            raise RuntimeError('A journal is already open')
+        journal = Journal(self, directory, fsync, batch_size, compact_every)
+        journal.open()
+        self._journal = journal
+
+    def flush_journal(self):
+        '''
+        Write and fsync the records the journal is holding back for batching.
+        '''
+        if self._journal is not None:
+            self._journal.flush()
+
+    def close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def set_instrumentation(self, enabled:bool):
+        '''
+        Start or stop measuring the phases of the object lifecycle. Stopping drops the measurements.
+        '''
+        if enabled and self._stats is None:
+            self._stats = Stats()
+        elif not enabled:
+            self._stats = None
+
+    def stats(self) -> Dict[str,Any]:
+        '''
+        Object and topic counts, and if the server is instrumented, the measurements of each phase:
+        phase -> object type -> count, total, mean, max, p50 and p99 in seconds, and a latency histogram.
+        Quantiles are the upper bounds of histogram buckets.
+        '''
+        return {
+            'instrumented': self._stats is not None,
+            'objects': len(self._objects),
+            'objects_by_type': {type_name: len(objects) for type_name, objects in self._objects_by_type.items()},
+            'topics': len(self._topicsync._state_machine._state),
+            'object_topics': len(self._topic_owners),
+            'history_items': len(self._transition_log),
+            'phases': self._stats.to_dict() if self._stats is not None else {},
+        }
+
+    def reset_stats(self):
+        if self._stats is not None:
+            self._stats.reset()
+
+    def register_stats_service(self, name:str='stats'):
+        '''
+        Let clients read stats() through a service.
+        '''
+        self.register_service(name, self.stats)
+
+    def _stats_type_name(self, obj:SObject) -> str:
+        # the root object type doesn't have to be registered
+        return self._object_types_to_names.get(obj.__class__, obj.__class__.__name__)
+
     def clear_history(self):
         # This is used when some change is made that invalidates the history, in other words, some not undoable change.
-        for obj in self.get_objects(): 
-            obj.history.clear() 
+        self._transition_log.clear()
 
     '''
     Encapsulate the topicsync server
@@ -254,9 +753,69 @@ class Server:
     def get_topic(self, topic_name, type: type[T]=Topic) -> T:
         return self._topicsync.topic(topic_name,type)
     
+    def _create_untracked_topic(self, topic_name, topic_type: type[T], init_value=None, is_stateful=True, order_strict=True) -> T:
+        '''
+        Create a topic without recording it in the current transition, like the topics made while creating an object.
+        Undoing the transition therefore doesn't remove it.
+        '''
+        with self._untracked():
+            return self.create_topic(topic_name, topic_type, init_value, is_stateful, order_strict)
+
+    @contextmanager
+    def _untracked(self):
+        '''
+        Changes made in this context are not recorded in the current transition, or in a new one if there is none.
+        '''
+        with self._topicsync.record(allow_reentry=True), self._topicsync._state_machine.enter_manual_mode():
+            yield
+
     def remove_topic(self, topic_name):
         self._topicsync.remove_topic(topic_name)
 
+    def _add_topic_owner(self, topic_name:str, owner:SObject):
+        '''
+        Route changes of the topic to the owner object when attributing a transition.
+        '''
+        self._topic_owners[topic_name] = owner
+
+    def _remove_object_topic(self, topic_name:str):
+        '''
+        Remove a topic owned by an object. Inside _batch_remove_topics, the removal is deferred until the batch ends.
+        '''
+        self._topic_owners.pop(topic_name, None)
+        if self._topics_to_remove is not None:
+            self._topics_to_remove.append(topic_name)
+        else:
+            self.remove_topic(topic_name)
+
+    @contextmanager
+    def _batch_remove_topics(self):
+        '''
+        Collect the topics removed by _remove_object_topic and remove them together on exit.
+        '''
+        if self._topics_to_remove is not None:
+            yield
+            return
+        topic_names = self._topics_to_remove = []
+        try:
+            yield
+        finally:
+            self._topics_to_remove = None
+            self._remove_topics(topic_names)
+
+    def _remove_topics(self, topic_names:List[str]):
+        # Removing topics through the topic list with one change copies the whole list, so only do it
+        # when the removed topics are a significant share of all topics. Otherwise remove them one by one.
+        if len(topic_names) < 2 or len(topic_names) * 8 < len(self._topic_owners):
+            for topic_name in topic_names:
+                self.remove_topic(topic_name)
+            return
+        topic_list = self._topicsync.topic('_topicsync/topic_list', DictTopic)
+        value = topic_list.get()
+        for topic_name in topic_names:
+            del value[topic_name]
+        topic_list.set(value)
+
     def on(self, event_name: str, callback: Callable, inverse_callback: Callable|None = None, is_stateful: bool = True,auto=False, *args, **kwargs: None):
         self._topicsync.on(event_name, callback, inverse_callback, is_stateful,auto=auto)
 
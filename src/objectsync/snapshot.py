@@ -0,0 +1,257 @@
+'''
+Compact binary snapshot of the object tree.
+
+Layout (little endian):
+
+    header      magic, version, id count, table sizes and section offsets
+    names       interned strings: type names, attribute names, attribute type names and reference names
+    ids         other strings: object ids and referenced ids
+    nodes       one fixed size record per object, in pre-order
+    attributes  one fixed size record per attribute, grouped by node
+    refs        u32 array holding each node's user references and wrapped topic names
+    blobs       JSON encoded attribute values
+
+A string table is an array of count+1 u64 offsets followed by the utf-8 bytes.
+Children are not stored explicitly: in pre-order, the children of node i start at i+1 and
+each is followed by its own subtree, whose size is kept in the node record.
+'''
+from __future__ import annotations
+from collections.abc import Mapping
+import json
+import mmap
+import struct
+from typing import TYPE_CHECKING, Dict, Iterator, List
+
+from objectsync.sobject import SObjectSerialized
+
+if TYPE_CHECKING:
+    from objectsync.server import Server
+    from objectsync.sobject import SObject
+
+MAGIC = b'OSSN'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHHQIIIII6Q')
+_NODE = struct.Struct('<IIIIII') # id, type, subtree size, first attribute, attribute count, first ref
+_ATTR = struct.Struct('<IIBxxxQQ') # name, type name, flags, blob offset, blob length
+_U32 = struct.Struct('<I')
+
+_STATEFUL = 1
+_ORDER_STRICT = 2
+
+class _StringTable:
+    def __init__(self) -> None:
+        self.strings : List[str] = []
+        self.indices : Dict[str,int] = {}
+
+    def index(self, string:str) -> int:
+        index = self.indices.get(string)
+        if index is None:
+            index = self.indices[string] = len(self.strings)
+            self.strings.append(string)
+        return index
+
+    def pack(self) -> bytes:
+        encoded = [string.encode('utf-8') for string in self.strings]
+        offsets = [0]
+        for data in encoded:
+            offsets.append(offsets[-1] + len(data))
+        return struct.pack(f'<{len(offsets)}Q', *offsets) + b''.join(encoded)
+
+def save_snapshot(server:Server, path:str):
+    '''
+    Write the children of the root object and their subtrees to path.
+    '''
+    names = _StringTable()
+    ids = _StringTable()
+    nodes : List[List[int]] = []
+    parents : List[int] = []
+    attrs = bytearray()
+    refs : List[int] = []
+    blobs = bytearray()
+    n_attrs = 0
+
+    # pre-order walk, children pushed in reverse so they are written in their original order
+    stack : List[tuple[SObject,int]] = [(child, -1) for child in reversed(server.get_root_object().get_children())]
+    while stack:
+        obj, parent = stack.pop()
+        index = len(nodes)
+        attributes, wrapped_topics = obj._serialize_attributes()
+        nodes.append([ids.index(obj.get_id()), names.index(obj.get_type_name()), 1, n_attrs, len(attributes), len(refs)])
+        parents.append(parent)
+
+        for name, type_name, value, is_stateful, order_strict in attributes:
+            blob = json.dumps(value).encode('utf-8')
+            flags = (_STATEFUL if is_stateful else 0) | (_ORDER_STRICT if order_strict else 0)
+            attrs += _ATTR.pack(names.index(name), names.index(type_name), flags, len(blobs), len(blob))
+            blobs += blob
+        n_attrs += len(attributes)
+
+        refs.append(len(obj._user_attribute_references))
+        for ref_name, attr_name in obj._user_attribute_references.items():
+            refs.extend((names.index(ref_name), names.index(attr_name)))
+        refs.append(len(obj._user_sobject_references))
+        for ref_name, sobject_id in obj._user_sobject_references.items():
+            refs.extend((names.index(ref_name), ids.index(sobject_id)))
+        refs.append(len(wrapped_topics))
+        refs.extend(names.index(name) for name in wrapped_topics)
+
+        stack.extend((child, index) for child in reversed(obj.get_children()))
+
+    # parents come before their descendants, so accumulating backwards gives the subtree sizes
+    for index in range(len(nodes) - 1, -1, -1):
+        if parents[index] != -1:
+            nodes[parents[index]][2] += nodes[index][2]
+
+    sections = [
+        names.pack(),
+        ids.pack(),
+        b''.join(_NODE.pack(*node) for node in nodes),
+        bytes(attrs),
+        struct.pack(f'<{len(refs)}I', *refs),
+        bytes(blobs),
+    ]
+    offsets = []
+    offset = _HEADER.size
+    for section in sections:
+        offsets.append(offset)
+        offset += len(section)
+
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, 0, server.get_id_count(),
+            len(names.strings), len(ids.strings), len(nodes), n_attrs, len(refs), *offsets))
+        for section in sections:
+            f.write(section)
+
+class SnapshotReader:
+    '''
+    Reads a snapshot through a memory map. Nodes are decoded into SObjectSerialized on demand, and
+    their children mapping is lazy, so restoring a tree only keeps the nodes along the current path alive.
+    '''
+    def __init__(self, path:str):
+        self._file = open(path, 'rb')
+        self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.id_count, n_names, self._n_ids, self._n_nodes, _, _, \
+            names_offset, self._ids_offset, self._nodes_offset, self._attrs_offset, self._refs_offset, self._blobs_offset \
+            = _HEADER.unpack_from(self._buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not an objectsync snapshot')
+        if version != VERSION:
+            raise ValueError(f'Unsupported snapshot version {version}')
+        # interned names are few, decode them all up front
+        self._names = [self._read_string(names_offset, n_names, i) for i in range(n_names)]
+
+    def close(self):
+        self._buffer.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _read_string(self, table_offset:int, count:int, index:int) -> str:
+        start, end = struct.unpack_from('<2Q', self._buffer, table_offset + 8 * index)
+        data_offset = table_offset + 8 * (count + 1)
+        return str(self._buffer[data_offset + start:data_offset + end], 'utf-8')
+
+    def _read_id(self, index:int) -> str:
+        return self._read_string(self._ids_offset, self._n_ids, index)
+
+    def _subtree_size(self, node:int) -> int:
+        return _U32.unpack_from(self._buffer, self._nodes_offset + _NODE.size * node + 8)[0]
+
+    def _child_nodes(self, node:int) -> Iterator[int]:
+        child = node + 1
+        end = node + self._subtree_size(node)
+        while child < end:
+            yield child
+            child += self._subtree_size(child)
+
+    def roots(self) -> Iterator[SObjectSerialized]:
+        '''
+        The saved children of the root object, in order.
+        '''
+        node = 0
+        while node < self._n_nodes:
+            yield self.read_node(node)
+            node += self._subtree_size(node)
+
+    def read_node(self, node:int) -> SObjectSerialized:
+        buffer = self._buffer
+        names = self._names
+        id, type, _, first_attr, n_attrs, ref = _NODE.unpack_from(buffer, self._nodes_offset + _NODE.size * node)
+
+        attributes = []
+        for i in range(first_attr, first_attr + n_attrs):
+            name, type_name, flags, blob_offset, blob_len = _ATTR.unpack_from(buffer, self._attrs_offset + _ATTR.size * i)
+            start = self._blobs_offset + blob_offset
+            value = json.loads(buffer[start:start + blob_len])
+            attributes.append([names[name], names[type_name], value, bool(flags & _STATEFUL), bool(flags & _ORDER_STRICT)])
+
+        def read_u32() -> int:
+            nonlocal ref
+            value = _U32.unpack_from(buffer, self._refs_offset + 4 * ref)[0]
+            ref += 1
+            return value
+        user_attribute_references = {}
+        for _ in range(read_u32()):
+            ref_name = names[read_u32()]
+            user_attribute_references[ref_name] = names[read_u32()]
+        user_sobject_references = {}
+        for _ in range(read_u32()):
+            ref_name = names[read_u32()]
+            user_sobject_references[ref_name] = self._read_id(read_u32())
+        wrapped_topics = [names[read_u32()] for _ in range(read_u32())]
+
+        return SObjectSerialized(
+            id = self._read_id(id),
+            type = names[type],
+            attributes = attributes,
+            children = _LazyChildren(self, node), # type: ignore
+            user_attribute_references = user_attribute_references,
+            user_sobject_references = user_sobject_references,
+            wrapped_topics = wrapped_topics,
+        )
+
+class _LazyChildren(Mapping):
+    '''
+    Maps child id to SObjectSerialized, decoding children from the snapshot only when accessed.
+    '''
+    def __init__(self, reader:SnapshotReader, node:int):
+        self._reader = reader
+        self._node = node
+        self._index : Dict[str,int]|None = None
+
+    def _get_index(self) -> Dict[str,int]:
+        if self._index is None:
+            reader = self._reader
+            self._index = {reader._read_id(_U32.unpack_from(reader._buffer, reader._nodes_offset + _NODE.size * child)[0]): child
+                for child in reader._child_nodes(self._node)}
+        return self._index
+
+    def __getitem__(self, id:str) -> SObjectSerialized:
+        return self._reader.read_node(self._get_index()[id])
+
+    def __iter__(self):
+        return iter(self._get_index())
+
+    def __len__(self):
+        return len(self._get_index())
+
+    def values(self) -> List[SObjectSerialized]: # type: ignore
+        return [self._reader.read_node(child) for child in self._reader._child_nodes(self._node)]
+
+def load_snapshot(server:Server, path:str):
+    '''
+    Restore the objects saved by save_snapshot as children of the root object.
+    The restore is not undoable, and the history is cleared.
+    '''
+    with SnapshotReader(path) as reader:
+        with server.record(allow_reentry=True), server._batch_objects_topic():
+            for serialized in reader.roots():
+                server._create_object(serialized.type, 'root', serialized.id, serialized)
+        if reader.id_count > server.get_id_count():
+            server.set_id_count(reader.id_count)
+    server.clear_history_inclusive()
@@ -1,38 +1,61 @@
 from __future__ import annotations
+import copy
+import weakref
 import logging
 
 from objectsync.utils import snake_to_camel
 logger = logging.getLogger(__name__)
-from dataclasses import dataclass, field
-from typing import List, Dict, Any, Optional, Self, TypeVar, Union, TYPE_CHECKING, Callable
+from collections import deque
+from dataclasses import dataclass
+from typing import List, Dict, Any, Optional, Self, Tuple, TypeVar, Union, TYPE_CHECKING, Callable, ValuesView, Iterator
 import typing
 from topicsync.topic import SetTopic, Topic, IntTopic, StringTopic, DictTopic, ListTopic, EventTopic, FloatTopic, GenericTopic
 from objectsync.topic import ObjDictTopic, ObjListTopic, ObjSetTopic, ObjTopic, WrappedTopic
 
 from objectsync.history import History, HistoryItem
+from objectsync.hierarchy_utils import AncestryNode
 from objectsync.count import gen_id
 
 if TYPE_CHECKING:
     from objectsync.server import Server
 
+def _copy_value(value:Any) -> Any:
+    '''
+    Copy a topic value. Values are JSON-like, so this is much faster than copy.deepcopy.
+    '''
+    if isinstance(value, dict):
+        return {key: _copy_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy_value(item) for item in value]
+    if isinstance(value, (set, tuple)):
+        return copy.deepcopy(value)
+    return value
+
 @dataclass
 class SObjectSerialized:
+    __slots__ = ('id', 'type', 'attributes', 'children', 'user_attribute_references', 'user_sobject_references', 'wrapped_topics', 'shared', '__weakref__')
     id:str
     type:str
     attributes:List[Any] # list of serialized attributes (topics)
     children:Dict[str,SObjectSerialized]
     user_attribute_references:Dict[str,str]
     user_sobject_references:Dict[str,str]
-    wrapped_topics:List[str] = field(default_factory=list) # DEPRECATED: the default value is for old format
+    wrapped_topics:List[str] # DEPRECATED: defaults to [] for old format
     def __init__(self, id: str, type: str, attributes: List[List], children: Dict[str, SObjectSerialized], user_attribute_references: Dict[str, str], user_sobject_references: Dict[str, str], wrapped_topics: List[str] = None):
         self.id = id
         self.type = type
         self.attributes = attributes
-        self.attributes_info = list(map(self._to_info_format, attributes))
         self.children = children
         self.user_attribute_references = user_attribute_references
         self.user_sobject_references = user_sobject_references
         self.wrapped_topics = wrapped_topics if wrapped_topics is not None else []
+        self.shared = False
+        ''' True if the node is interned in a SerializedPool and may be referenced by several history entries. Do not modify it. '''
+
+    @property
+    def attributes_info(self) -> List[List]:
+        ''' The attributes in the 5 element format. Computed on access, nothing reads it while restoring. '''
+        return list(map(self._to_info_format, self.attributes))
 
     def _to_info_format(self, attributes: List) -> List:
         if len(attributes) == 3:
@@ -56,7 +79,13 @@ class SObjectSerialized:
             'user_sobject_references':self.user_sobject_references,
             'wrapped_topics':self.wrapped_topics
         }
-    
+
+    @staticmethod
+    def from_dict(d:Dict[str,Any])->SObjectSerialized:
+        return SObjectSerialized(d['id'], d['type'], d['attributes'],
+            {child_id:SObjectSerialized.from_dict(child) for child_id,child in d['children'].items()},
+            d['user_attribute_references'], d['user_sobject_references'], d.get('wrapped_topics'))
+
     def get_child(self, name:str)->SObjectSerialized:
         '''
         input: name of the child
@@ -89,6 +118,35 @@ class SObjectSerialized:
         for child in self.children.values():
             child.update_references(id_map)
 
+    def with_new_ids(self) -> SObjectSerialized:
+        '''
+        Returns a copy of the subtree where every object has a new id, so it can be created next to the original.
+        References between objects in the subtree point to the copies, references to objects outside are kept.
+        '''
+        # assign ids in pre-order so the copies keep the relative order of the originals
+        id_map = {}
+        stack : List[SObjectSerialized] = [self]
+        while stack:
+            node = stack.pop()
+            id_map[node.id] = gen_id()
+            stack.extend(reversed(list(node.children.values())))
+        copied = self._copy_with_ids(id_map)
+        copied.update_references(id_map)
+        return copied
+
+    def _copy_with_ids(self, id_map:Dict[str,str]) -> SObjectSerialized:
+        return SObjectSerialized(
+            id = id_map[self.id],
+            type = self.type,
+            # the 5 element format, since the 3 element one embeds the topic names of the original
+            attributes = [[name, type_name, _copy_value(value), is_stateful, order_strict]
+                for name, type_name, value, is_stateful, order_strict in self.attributes_info],
+            children = {id_map[child_id]: child._copy_with_ids(id_map) for child_id, child in self.children.items()},
+            user_attribute_references = dict(self.user_attribute_references),
+            user_sobject_references = {name: id_map.get(id, id) for name, id in self.user_sobject_references.items()},
+            wrapped_topics = list(self.wrapped_topics),
+        )
+
     def update_type_names(self, type_map:Dict[str,str]):
         '''
         input: a dictionary mapping old type names to new type names
@@ -102,10 +160,114 @@ class SObjectSerialized:
     def __dict__(self):
         return self.to_dict()
 
+_topic_types : Dict[str,type] = {}
+''' Topic classes by serialized type name '''
+
+def _get_topic_type(type_name:str) -> type:
+    topic_type = _topic_types.get(type_name)
+    if topic_type is None:
+        # the type_name is a string, so we need to convert it to a type object
+        full_type_name = snake_to_camel(type_name)+'Topic'
+        full_type_name = full_type_name[0].upper() + full_type_name[1:]
+        # grab the type from the air. Hacker.
+        topic_type = _topic_types[type_name] = globals()[full_type_name]
+    return topic_type
+
+_attribute_plans : Dict[Tuple[str,int],Tuple[type,int]] = {}
+''' (topic type name, number of fields) -> (topic type, number of fields) '''
+
+def _get_attribute_plan(type_name:str, n_fields:int) -> Tuple[type,int]:
+    key = (type_name, n_fields)
+    plan = _attribute_plans.get(key)
+    if plan is None:
+        plan = _attribute_plans[key] = (_get_topic_type(type_name), n_fields)
+    return plan
+
+def _get_deserialize_plan(attributes:List[List]) -> List[tuple]:
+    '''
+    Returns (name, topic type, number of fields) for each attribute.
+    The cache is keyed by topic type name and number of fields only, so it stays as small as the set of topic types
+    even when attribute names depend on the data.
+    '''
+    return [(attr[0], *_get_attribute_plan(attr[1], len(attr))) for attr in attributes]
+
+T0 = TypeVar('T0')
+class Attribute(typing.Generic[T0]):
+    '''
+    Declares an attribute at class level. Every new instance gets the attribute before build() runs,
+    and it is available as an instance attribute of the same name.
+
+        class Text(SObject):
+            text = Attribute(StringTopic, 'hello')
+            style = Attribute(DictTopic, {})
+
+    The arguments are the same as add_attribute's. name defaults to the name of the class attribute.
+    The default value is copied for each instance.
+    '''
+    def __init__(self, topic_type:type[T0], init_value=None, is_stateful=True, order_strict=None, name:str|None=None):
+        self.topic_type = topic_type
+        self.init_value = init_value
+        self.is_stateful = is_stateful
+        self.order_strict = is_stateful if order_strict is None else order_strict
+        self.name = name
+
+    def __set_name__(self, owner, name):
+        self.ref_name = name
+        if self.name is None:
+            self.name = name
+
+    @typing.overload
+    def __get__(self, obj:None, objtype) -> Attribute[T0]: ...
+    @typing.overload
+    def __get__(self, obj:SObject, objtype) -> T0: ...
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        # initialize() sets an instance attribute of the same name, which shadows this
+        raise AttributeError(f"Attribute '{self.ref_name}' of {obj} is not created yet")
+
+class _AttributeSchema:
+    def __init__(self, cls:type) -> None:
+        declared : Dict[str,Attribute] = {}
+        for klass in reversed(cls.__mro__):
+            for value in vars(klass).values():
+                if isinstance(value, Attribute):
+                    declared[value.ref_name] = value
+        self.entries = []
+        ''' (reference name, attribute name, topic type, default value, copy the default?, is_stateful, order_strict, wrapped?) '''
+        for attribute in declared.values():
+            origin_type = typing.get_origin(attribute.topic_type) or attribute.topic_type
+            self.entries.append((
+                attribute.ref_name,
+                attribute.name,
+                attribute.topic_type,
+                attribute.init_value,
+                not isinstance(attribute.init_value, str|int|float|bool|None),
+                attribute.is_stateful,
+                attribute.order_strict,
+                issubclass(origin_type, WrappedTopic),
+            ))
+        self.references = {entry[0]: entry[1] for entry in self.entries}
+        ''' user attribute references contributed by the schema '''
+
+_attribute_schemas : weakref.WeakKeyDictionary[type,_AttributeSchema] = weakref.WeakKeyDictionary()
+''' Released with their class, so classes created at runtime don't pile up '''
+
+def _get_attribute_schema(cls:type) -> _AttributeSchema:
+    schema = _attribute_schemas.get(cls)
+    if schema is None:
+        schema = _attribute_schemas[cls] = _AttributeSchema(cls)
+    return schema
+
 class SObject:
     frontend_type = 'Root'
     ''' The type of the object that will be displayed in the frontend. '''
 
+    # Internal fields live in slots. __dict__ is kept for the attributes and references user code sets in build().
+    __slots__ = ('_server', '_id', '_parent_id', '_tags', '_parent', '_depth', '_ancestry', '_attributes', '_children',
+                 '_children_by_type', '_history', '_history_start', '_destroyed', 'is_new',
+                 '_user_attribute_references', '_user_sobject_references', '__dict__', '__weakref__')
+
     '''
     Initialization
     '''
@@ -113,35 +275,79 @@ class SObject:
         self._server = server
         self._id = id
         self._parent_id = self._server.create_topic(f"parent_id/{id}", StringTopic, parent_id)
-        self._tags = self._server.create_topic(f"tags/{id}", SetTopic, is_stateful=False)
         self._parent_id.on_set2 += self._on_parent_changed
+        self._server._add_topic_owner(self._parent_id.get_name(), self)
+        self._tags : SetTopic|None = None
+        if not self._server.lean:
+            self._create_tags_topic(self._server.create_topic)
+        # cached from the parent_id topic so hierarchy walks need no topic reads or id lookups
+        self._parent : SObject|None = None if id == 'root' else self._server.get_object(parent_id)
+        self._depth : int = 0 if self._parent is None else self._parent._depth + 1
+        self._ancestry = AncestryNode(self, None if self._parent is None else self._parent._ancestry)
         self._attributes : Dict[str,Topic|WrappedTopic] = {}
-        self._children : List[SObject] = []
-        self.history : History = History()
+        self._children : Dict[str,SObject] = {} # insertion ordered
+        self._children_by_type : Dict[type[SObject],Dict[str,SObject]] = {}
+        # the History is made on first use. Until then, it would have no cursor and nothing to remember but where it starts.
+        self._history : History|None = None
+        self._history_start = self._server._transition_log.end_index()
         self._destroyed = False
 
     def initialize(self, serialized:SObjectSerialized|None=None,build_kwargs:Dict[str,Any]=None,call_init:bool=True):
         if build_kwargs is None:
             build_kwargs = {}
         self.is_new = serialized is None
+        schema = _get_attribute_schema(self.__class__)
+        stats = self._server._stats
         if serialized is None:
-            self.build(**build_kwargs)
+            for entry in schema.entries:
+                self._add_declared_attribute(*entry)
+            if stats is None:
+                self.build(**build_kwargs)
+            else:
+                stats.call('build', self._server._stats_type_name(self), self.build, **build_kwargs)
 
             # collect attributes and sobjects references
-            self._user_attribute_references = {}
+            self._user_attribute_references = dict(schema.references)
             self._user_sobject_references = {}
+            attribute_ids = {id(attribute) for attribute in self._attributes.values()}
             for k, v in self.__dict__.items():
                 if isinstance(v, Topic|WrappedTopic):
-                    if not v in self._attributes.values():
+                    if k in schema.references or id(v) not in attribute_ids:
                         continue
                     self._user_attribute_references[k] = v.get_name().split('/')[-1]
                 elif isinstance(v, SObject):
                     self._user_sobject_references[k] = v.get_id()
         else:
-            self._deserialize(serialized)
+            if stats is None:
+                self._deserialize(serialized)
+            else:
+                stats.call('deserialize', self._server._stats_type_name(self), self._deserialize, serialized)
+            if len(schema.entries):
+                # attributes declared after the data was saved
+                for entry in schema.entries:
+                    if entry[1] not in self._attributes:
+                        self._add_declared_attribute(*entry)
+                        self._user_attribute_references = {**self._user_attribute_references, entry[0]: entry[1]}
         
         if call_init:
-            self.init()
+            if stats is None:
+                self.init()
+            else:
+                stats.call('init', self._server._stats_type_name(self), self.init)
+
+    def _add_declared_attribute(self, ref_name, name, topic_type, init_value, copy_default, is_stateful, order_strict, wrapped):
+        if copy_default:
+            init_value = copy.deepcopy(init_value)
+        if wrapped:
+            new_attr = self.add_attribute(name, topic_type, init_value, is_stateful, order_strict)
+        else:
+            # the plain topic path of add_attribute, without resolving the type again
+            if name in self._attributes:
+                raise ValueError(f"Attribute '{name}' already exists")
+            new_attr = self._server.create_topic(f"a/{self._id}/{name}", topic_type, init_value, is_stateful, order_strict=order_strict)
+            self._attributes[name] = new_attr
+            self._server._add_topic_owner(new_attr.get_name(), self)
+        setattr(self, ref_name, new_attr)
 
     def build(self,**kwargs):
         '''
@@ -151,26 +357,22 @@ class SObject:
 
     def _deserialize(self, serialized:SObjectSerialized):
         # restore attributes
-        for attr_info in serialized.attributes:
-            serialized_topic = None
-            if len(attr_info)==4: # DEPRECATED old format.
-                name, type_name, value, is_stateful = attr_info
-                order_strict = is_stateful
-            elif len(attr_info) == 5:
-                name, type_name, value, is_stateful, order_strict = attr_info
+        attributes = serialized.attributes
+        shared = serialized.shared
+        for (name, topic_type, variant), attr_info in zip(_get_deserialize_plan(attributes), attributes):
+            if variant == 3:
+                serialized_topic = attr_info[2]
+                if shared:
+                    # the topic takes ownership of the value, so it must not be the shared one
+                    serialized_topic = _copy_value(serialized_topic)
+                self.restore_attribute(name, topic_type, serialized_topic)
             else:
-                name, type_name, serialized_topic = attr_info
-
-            # the type_name is a string, so we need to convert it to a type object
-            full_type_name = snake_to_camel(type_name)+'Topic'
-            full_type_name = full_type_name[0].upper() + full_type_name[1:]
-            # grab the type from the air. Hacker.
-            type = globals()[full_type_name]
-
-            if serialized_topic:
-                self.restore_attribute(name, type, serialized_topic)
-            else:
-                self.add_attribute(name, type, value, is_stateful, order_strict = order_strict)
+                value, is_stateful = attr_info[2], attr_info[3]
+                # order_strict is the same as is_stateful in the DEPRECATED 4 element format
+                order_strict = attr_info[4] if variant == 5 else is_stateful
+                if shared:
+                    value = _copy_value(value)
+                self.add_attribute(name, topic_type, value, is_stateful, order_strict = order_strict)
 
         # restore attribute references used in user code
         for ref_name, attr_name in serialized.user_attribute_references.items():
@@ -206,22 +408,79 @@ class SObject:
     '''
     def _on_parent_changed(self, old_parent_id, new_parent_id):
         self._server.get_object(old_parent_id)._remove_child(self)
-        self._server.get_object(new_parent_id)._add_child(self)
+        new_parent = self._server.get_object(new_parent_id)
+        new_parent._add_child(self)
+        self._parent = new_parent
+        self._update_hierarchy()
+        if self._server._interest:
+            self._server._interest.reparented(self)
+
+    def _create_tags_topic(self, create_topic):
+        self._tags = create_topic(f"tags/{self._id}", SetTopic, is_stateful=False)
+        # raw callbacks so the server's tag index also follows client and undo changes
+        self._tags.on_append.add_raw(self._on_tag_added)
+        self._tags.on_remove.add_raw(self._on_tag_removed)
+        self._server._add_topic_owner(self._tags.get_name(), self)
+
+    def _get_tags_topic(self) -> SetTopic:
+        if self._tags is None:
+            # created after the object, so keep it out of the current transition like the topics created with the object
+            self._create_tags_topic(self._server._create_untracked_topic)
+        return self._tags # type: ignore
+
+    @property
+    def history(self) -> History:
+        if self._history is None:
+            self._history = History(self._server._transition_log, self, self._history_start)
+        return self._history
+
+    def _on_tag_added(self, auto, tag):
+        self._server._add_tag_index(tag, self)
+
+    def _on_tag_removed(self, auto, tag):
+        self._server._remove_tag_index(tag, self)
 
     '''
     Non API methods
     '''
-    
+
+    def _update_hierarchy(self):
+        '''
+        Recompute the cached depth and ancestry of this object and its descendants after reparenting.
+        '''
+        stack = [self]
+        while stack:
+            obj = stack.pop()
+            parent = obj._parent
+            assert parent is not None
+            obj._depth = parent._depth + 1
+            obj._ancestry = AncestryNode(obj, parent._ancestry)
+            stack.extend(obj._children.values())
+
     def _add_child(self, child:SObject):
         logger.debug(f"Adding child {child.get_id()} to {self.get_id()}")
-        for c in self._children:
-            if c.get_id() == child.get_id():
-                raise ValueError(f"Child {child.get_id()} already exists")
-        self._children.append(child)
+        child_id = child.get_id()
+        if child_id in self._children:
+            raise ValueError(f"Child {child_id} already exists")
+        self._children[child_id] = child
+        bucket = self._children_by_type.get(child.__class__)
+        if bucket is None:
+            bucket = self._children_by_type[child.__class__] = {}
+        bucket[child_id] = child
     
     def _remove_child(self, child:SObject):
         logger.debug(f"Removing child {child.get_id()} from {self.get_id()}")
-        self._children.remove(child)
+        child_id = child.get_id()
+        if self._children.get(child_id) is not child:
+            raise ValueError(f"Child {child_id} not found")
+        del self._children[child_id]
+        bucket = self._children_by_type[child.__class__]
+        del bucket[child_id]
+        if len(bucket) == 0:
+            del self._children_by_type[child.__class__]
+
+    def _get_children_buckets(self, type: type[SObject]) -> List[Dict[str,SObject]]:
+        return [bucket for cls, bucket in self._children_by_type.items() if issubclass(cls, type)]
 
     '''
     Public methods
@@ -249,13 +508,26 @@ class SObject:
         new_child = self._server.get_object(id)
         return new_child
     
+    def add_children(self, children:List[Dict[str,Any]]) -> List[SObject]:
+        '''
+        Create many children as a single change. See Server.create_objects for the format of children.
+        The parent_id of each item defaults to this object.
+        '''
+        return self._server.create_objects([{'parent_id': self._id, **child} for child in children])
+
     def remove_child(self, child:SObject): # Maybe deprecate this
         self._server.destroy_object(child.get_id())
     
     def get_parent(self):
         if self._id == 'root':
             raise NotImplementedError('Cannot call get_parent of root object')
-        return self._server.get_object(self._parent_id.get())
+        return self._parent
+
+    def get_depth(self) -> int:
+        '''
+        Number of edges between this object and the root.
+        '''
+        return self._depth
 
     T1 = TypeVar("T1", bound=Topic|WrappedTopic)
     def restore_attribute(self, topic_name, topic_type: type[T1], serialized) -> T1:
@@ -263,6 +535,7 @@ class SObject:
             raise ValueError(f"Attribute '{topic_name}' already exists")
         new_attr = self._server.restore_topic(f"a/{self._id}/{topic_name}", topic_type, serialized)
         self._attributes[topic_name] = new_attr
+        self._server._add_topic_owner(new_attr.get_name(), self)
         return new_attr
 
     def add_attribute(self, topic_name, topic_type: type[T1], init_value=None, is_stateful=True,order_strict=None) -> T1: 
@@ -307,12 +580,13 @@ class SObject:
         else:
             new_attr = self._server.create_topic(f"a/{self._id}/{topic_name}", topic_type, init_value, is_stateful,order_strict=order_strict) # type: ignore
         self._attributes[topic_name] = new_attr
+        self._server._add_topic_owner(new_attr.get_name(), self)
         return new_attr # type: ignore
     
     def remove_attribute(self, topic_name):
         if topic_name not in self._attributes:
             raise ValueError(f"Attribute '{topic_name}' does not exist")
-        self._server.remove_topic(self._attributes[topic_name].get_name())
+        self._server._remove_object_topic(self._attributes[topic_name].get_name())
         del self._attributes[topic_name]
     
     def get_attribute(self, topic_name) -> Topic|WrappedTopic:
@@ -327,11 +601,13 @@ class SObject:
         self._server.emit(f"a/{self._id}/{event_name}", **kwargs)
         if event_name not in self._attributes:
             self._attributes[event_name] = self._server.get_topic(f"a/{self._id}/{event_name}")
+            self._server._add_topic_owner(f"a/{self._id}/{event_name}", self)
     
     def on(self, event_name: str, callback: Callable, inverse_callback: Callable|None = None, is_stateful: bool = True,auto=False):
         self._server.on(f"a/{self._id}/{event_name}", callback, inverse_callback, is_stateful,auto=auto)
         if event_name not in self._attributes:
             self._attributes[event_name] = self._server.get_topic(f"a/{self._id}/{event_name}")
+            self._server._add_topic_owner(f"a/{self._id}/{event_name}", self)
 
     def register_service(self, service_name: str, callback: Callable, pass_sender: bool = False):
         self._server.register_service(f"{self._id}/{service_name}", callback, pass_sender)
@@ -348,8 +624,11 @@ class SObject:
             
         self._destroyed = True
 
-        self._server.remove_topic(self._parent_id.get_name())
-        self._server.remove_topic(self._tags.get_name())
+        self._server._remove_object_topic(self._parent_id.get_name())
+        if self._tags is not None:
+            for tag in self._tags:
+                self._server._remove_tag_index(tag, self)
+            self._server._remove_object_topic(self._tags.get_name())
 
         attributes_serialized = []
         for name, attr in self._attributes.items():
@@ -363,10 +642,10 @@ class SObject:
                     [name, attr.get_type_name(), attr.serialize()]
                 )
 
-            self._server.remove_topic(attr.get_name())
+            self._server._remove_object_topic(attr.get_name())
 
         children_serialized = {}
-        for child in self._children.copy():
+        for child in list(self._children.values()):
             logger.debug(f"Destroying child {child.get_id()} from {self.get_id()}")
             child_info = self._server._destroy_object(child.get_id())
             children_serialized[child.get_id()] = child_info['serialized']
@@ -389,22 +668,31 @@ class SObject:
     def is_destroyed(self):
         return self._destroyed
     
-    def serialize(self) -> SObjectSerialized:
-
+    def _serialize_attributes(self) -> tuple[List[List], List[str]]:
+        '''
+        Returns the attributes in the 5 element format and the names of the wrapped ones.
+        '''
         attributes_serialized = []
+        wrapped_topics = []
         for name, attr in self._attributes.items():
             if isinstance(attr, WrappedTopic):
                 value = attr.get_raw()
+                wrapped_topics.append(attr.get_name().split('/')[-1])
             else:
                 value = attr.get()
             attributes_serialized.append([name,attr.get_type_name(),value,attr.is_stateful(),attr.is_order_strict()])
+        return attributes_serialized, wrapped_topics
 
-        children_serialized = {child.get_id(): child.serialize() for child in self._children}
+    def serialize(self) -> SObjectSerialized:
+        stats = self._server._stats
+        if stats is not None:
+            return stats.call('serialize', self._server._stats_type_name(self), self._serialize)
+        return self._serialize()
 
-        wrapped_topics = []
-        for attribute in self._attributes.values():
-            if isinstance(attribute, WrappedTopic):
-                wrapped_topics.append(attribute.get_name().split('/')[-1])
+    def _serialize(self) -> SObjectSerialized:
+        attributes_serialized, wrapped_topics = self._serialize_attributes()
+
+        children_serialized = {child_id: child.serialize() for child_id, child in self._children.items()}
 
         return SObjectSerialized(
             id = self._id,
@@ -416,53 +704,105 @@ class SObject:
             wrapped_topics=wrapped_topics
         )
 
+    def serialize_with_new_ids(self) -> SObjectSerialized:
+        '''
+        Serialize a copy of the subtree where every object has a new id, for copy/paste.
+        The ids are replaced while serializing, so there is no second pass over a serialized tree.
+        References between objects in the subtree point to the copies, references to objects outside are kept.
+        '''
+        id_map = {obj._id: gen_id() for obj in self.traverse(type=SObject)}
+        serialized = self._serialize_with_ids(id_map)
+        serialized.update_references(id_map)
+        return serialized
+
+    def _serialize_with_ids(self, id_map:Dict[str,str]) -> SObjectSerialized:
+        attributes_serialized, wrapped_topics = self._serialize_attributes()
+        return SObjectSerialized(
+            id = id_map[self._id],
+            type = self._server.get_object_type_name(self.__class__),
+            attributes = attributes_serialized,
+            children = {id_map[child_id]: child._serialize_with_ids(id_map) for child_id, child in self._children.items()},
+            user_attribute_references=dict(self._user_attribute_references),
+            user_sobject_references={name: id_map.get(id, id) for name, id in self._user_sobject_references.items()},
+            wrapped_topics=wrapped_topics
+        )
+
     def add_tag(self, tag):
-        self._tags.append(tag)
+        self._get_tags_topic().append(tag)
 
     def remove_tag(self, tag):
-        self._tags.remove(tag)
+        self._get_tags_topic().remove(tag)
 
     def has_tag(self, tag):
-        return tag in self._tags
+        return self._tags is not None and tag in self._tags
     
     def has_child(self, child:SObject):
-        return child in self._children
+        return self._children.get(child.get_id()) is child
         
     T2 = TypeVar("T2", bound='SObject')
     def get_child_of_type(self, type: type[T2])->T2:
-        for child in self._children:
-            if isinstance(child, type):
-                return child
+        buckets = self._get_children_buckets(type)
+        if len(buckets) == 1:
+            return next(iter(buckets[0].values())) # type: ignore
+        if len(buckets) > 1:
+            # children of several subclasses match, find the first one in insertion order
+            for child in self._children.values():
+                if isinstance(child, type):
+                    return child
         raise ValueError(f"Child of type {type} not found")
     
     T3=TypeVar("T3", bound='SObject')
     def get_children_of_type(self, type: type[T3])-> list[T3]:
-        return [child for child in self._children if isinstance(child, type)]
+        buckets = self._get_children_buckets(type)
+        if len(buckets) == 0:
+            return []
+        if len(buckets) == 1:
+            return list(buckets[0].values()) # type: ignore
+        return [child for child in self._children.values() if isinstance(child, type)]
     
-    def get_children(self):
-        return self._children.copy()
+    def get_children(self) -> ValuesView[SObject]:
+        '''
+        Returns a live, read-only view of the children in insertion order.
+        Copy it with list() before adding or removing children while iterating.
+        '''
+        return self._children.values()
     
     def get_child_by_id(self, id:str)->SObject:
-        for child in self._children:
-            if child.get_id() == id:
-                return child
-        raise ValueError(f"Child {id} not found")
+        child = self._children.get(id)
+        if child is None:
+            raise ValueError(f"Child {id} not found")
+        return child
     
     def get_type_name(self):
         return self._server.get_object_type_name(self.__class__)
     
     T4 = TypeVar("T4", bound='SObject')
-    def top_down_search(self, accept: Callable[['SObject'], bool]|None = None,stop: Callable[['SObject'], bool]|None = None, type:type[T4]=Self)-> list[T4]:
-        result = []
+    def traverse(self, accept: Callable[['SObject'], bool]|None = None,stop: Callable[['SObject'], bool]|None = None, type:type[T4]=Self, breadth_first:bool=False)-> Iterator[T4]:
+        '''
+        Lazily yields this object and its descendants that are instances of type and pass accept.
+        The children of an object are not visited if stop returns True for it.
+        Objects are visited in pre-order, or level by level if breadth_first is True.
+        Stop iterating (e.g. with itertools.islice) to avoid walking the rest of the subtree.
+        '''
         if type is Self:
             type = self.__class__ # type: ignore
-        if isinstance(self, type):
-            if accept is None or accept(self):
-                result.append(self)
-        if stop is None or not stop(self):
-            for child in self._children:
-                result += child.top_down_search(accept, stop, type)
-        return result
+        if breadth_first:
+            queue = deque([self])
+            pop = queue.popleft
+            push = queue.extend
+        else:
+            queue = [self]
+            pop = queue.pop
+            push = lambda children: queue.extend(reversed(children))
+        while queue:
+            obj = pop()
+            if isinstance(obj, type) and (accept is None or accept(obj)):
+                yield obj # type: ignore
+            if stop is None or not stop(obj):
+                push(obj._children.values())
+
+    def top_down_search(self, accept: Callable[['SObject'], bool]|None = None,stop: Callable[['SObject'], bool]|None = None, type:type[T4]=Self)-> list[T4]:
+        return list(self.traverse(accept, stop, type))
     
     def __str__(self) -> str:
         return f"{self.get_type_name()}({self._id})"
@@ -0,0 +1,103 @@
+'''
+Opt-in timing of the server's work, per phase and per object type.
+
+Phases:
+
+    build         SObject.build of a new object
+    deserialize   restoring an object from its serialized state
+    init          SObject.init
+    destroy       SObject.destroy
+    serialize     SObject.serialize
+    transition    attributing a transition to the lowest common ancestor and adding it to the history
+    undo, redo    undoing or redoing a transition, including the changes it makes
+
+The type is that of the object doing the work. For transition, undo and redo, it is the object whose history
+the transition goes to, or '' for transitions that no history records.
+
+Phases nest: building an object creates its children, which are built in turn. Each measurement only counts
+its self time, the time not spent in the measurements nested in it, so a slow build() shows up on the type
+that has it rather than on all of its ancestors.
+
+When the server is not instrumented, the only cost left is checking that Server._stats is None.
+'''
+from __future__ import annotations
+from time import perf_counter
+from typing import Any, Callable, Dict, List, Tuple
+
+BUCKETS = 24
+''' Histogram buckets: bucket i counts the measurements under 2**i microseconds, the last one also the longer ones '''
+
+class PhaseStats:
+    __slots__ = ('count', 'total', 'max', 'histogram')
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * BUCKETS
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.histogram[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+
+    def quantile(self, q: float) -> float:
+        ''' Upper bound of the bucket holding the q quantile, in seconds '''
+        target = q * self.count
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= target:
+                return min(2 ** bucket / 1e6, self.max)
+        return self.max
+
+    def to_dict(self) -> Dict[str,Any]:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            # only the buckets in use, keyed by their upper bound in microseconds
+            'histogram': {f'<{2 ** bucket}us': count for bucket, count in enumerate(self.histogram) if count},
+        }
+
+class Stats:
+    def __init__(self) -> None:
+        self._phases : Dict[Tuple[str,str],PhaseStats] = {}
+        self._nested : List[float] = []
+        ''' Time spent in the measurements nested in each running one '''
+
+    def start(self) -> float:
+        self._nested.append(0.0)
+        return perf_counter()
+
+    def stop(self, phase: str, type_name: str, start: float):
+        elapsed = perf_counter() - start
+        nested = self._nested.pop()
+        if self._nested:
+            self._nested[-1] += elapsed
+        key = (phase, type_name)
+        phase_stats = self._phases.get(key)
+        if phase_stats is None:
+            phase_stats = self._phases[key] = PhaseStats()
+        phase_stats.add(elapsed - nested)
+
+    def call(self, phase: str, type_name: str, function: Callable, /, *args, **kwargs):
+        start = self.start()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.stop(phase, type_name, start)
+
+    def reset(self):
+        self._phases.clear()
+
+    def to_dict(self) -> Dict[str,Dict[str,Dict[str,Any]]]:
+        ''' phase -> type name -> measurements '''
+        result : Dict[str,Dict[str,Dict[str,Any]]] = {}
+        for (phase, type_name), phase_stats in self._phases.items():
+            result.setdefault(phase, {})[type_name] = phase_stats.to_dict()
+        return result
@@ -0,0 +1,168 @@
+'''
+Streaming serialization of object trees, for subtrees too large to serialize in memory.
+
+SObject.serialize builds the whole SObjectSerialized tree before anything can be written. The writer here
+walks the tree iteratively and yields JSON lines as it goes, and the reader creates the objects while reading,
+so both only hold the siblings along the current path: memory is bounded by depth times fan-out, not size.
+
+The stream is a header line followed by blocks, one per object with children:
+
+    {"objectsync_stream": 1, "id_count": n}
+    {"parent": id, "children": [node, ...]}
+
+A node is a serialized object without its children, as in SObjectSerialized.to_dict, with "children" holding
+the number of children instead. The first block holds the top level nodes. After a block, the block of each
+of its nodes that has children follows, each followed by the blocks of its own descendants.
+
+Siblings come in one block because the server sorts them with deserialize_sort_key before creating them.
+If the sort changes their order, the reader buffers the blocks it has to skip.
+'''
+from __future__ import annotations
+from collections.abc import Mapping
+import json
+from typing import TYPE_CHECKING, Any, Dict, IO, Iterable, Iterator, List
+
+from objectsync.sobject import SObjectSerialized
+
+if TYPE_CHECKING:
+    from objectsync.server import Server
+    from objectsync.sobject import SObject
+
+VERSION = 1
+
+def _node_record(obj: SObject) -> Dict[str,Any]:
+    attributes, wrapped_topics = obj._serialize_attributes()
+    return {
+        'id': obj.get_id(),
+        'type': obj.get_type_name(),
+        'attributes': attributes,
+        'children': len(obj._children),
+        'user_attribute_references': obj._user_attribute_references,
+        'user_sobject_references': obj._user_sobject_references,
+        'wrapped_topics': wrapped_topics,
+    }
+
+def iter_records(server: Server, top: List[SObject]) -> Iterator[Dict[str,Any]]:
+    '''
+    Yields the header and the blocks of the subtrees of top as dicts. The objects in top must share a parent.
+    '''
+    root = server.get_root_object()
+    if any(obj is root for obj in top):
+        raise ValueError('The root object has no parent to be restored under. Stream its children instead.')
+    yield {'objectsync_stream': VERSION, 'id_count': server.get_id_count()}
+    parent_id = top[0].get_parent().get_id() if len(top) else root.get_id()
+    yield {'parent': parent_id, 'children': [_node_record(obj) for obj in top]}
+    # depth first, children pushed in reverse so blocks come in the order the nodes were written
+    stack = [obj for obj in reversed(top) if len(obj._children)]
+    while stack:
+        obj = stack.pop()
+        children = list(obj._children.values())
+        yield {'parent': obj.get_id(), 'children': [_node_record(child) for child in children]}
+        stack.extend(child for child in reversed(children) if len(child._children))
+
+def iter_json(server: Server, top: List[SObject]) -> Iterator[str]:
+    '''
+    Yields the stream of the subtrees of top as JSON lines, each ending with a newline.
+    '''
+    for record in iter_records(server, top):
+        yield json.dumps(record) + '\n'
+
+def save_stream(server: Server, file: IO[str], top: List[SObject]):
+    '''
+    Write the subtrees of top to file, which can be anything with a write method taking str.
+    '''
+    for chunk in iter_json(server, top):
+        file.write(chunk)
+
+class StreamReader:
+    '''
+    Reads blocks from the lines of a stream on demand.
+    '''
+    def __init__(self, lines: Iterable[str|bytes]):
+        self._lines = iter(lines)
+        self._skipped : Dict[str,List[Dict]] = {}
+        header = self._next_record()
+        if header is None or 'objectsync_stream' not in header:
+            raise ValueError('Not an objectsync stream')
+        if header['objectsync_stream'] != VERSION:
+            raise ValueError(f'Unsupported stream version {header["objectsync_stream"]}')
+        self.id_count : int = header['id_count']
+
+    def _next_record(self) -> Dict|None:
+        for line in self._lines:
+            if line.strip():
+                return json.loads(line)
+        return None
+
+    def roots(self) -> List[SObjectSerialized]:
+        '''
+        The top level nodes. Their children are read when the objects are restored.
+        '''
+        record = self._next_record()
+        if record is None:
+            raise ValueError('The stream ended before its first block')
+        return [self._read_node(node) for node in record['children']]
+
+    def _read_node(self, node: Dict) -> SObjectSerialized:
+        return SObjectSerialized(node['id'], node['type'], node['attributes'], _StreamChildren(self, node['id'], node['children']), # type: ignore
+            node['user_attribute_references'], node['user_sobject_references'], node.get('wrapped_topics'))
+
+    def read_children(self, parent_id: str) -> List[SObjectSerialized]:
+        nodes = self._skipped.pop(parent_id, None)
+        while nodes is None:
+            record = self._next_record()
+            if record is None:
+                raise ValueError(f'The stream ended before the children of {parent_id}')
+            if record['parent'] == parent_id:
+                nodes = record['children']
+            else:
+                self._skipped[record['parent']] = record['children']
+        return [self._read_node(node) for node in nodes]
+
+class _StreamChildren(Mapping):
+    '''
+    Maps child id to SObjectSerialized, reading the children from the stream when first accessed.
+    values() hands them out without keeping them, so restored subtrees can be released.
+    '''
+    def __init__(self, reader: StreamReader, parent_id: str, count: int):
+        self._reader = reader
+        self._parent_id = parent_id
+        self._count = count
+        self._children : Dict[str,SObjectSerialized]|None = None
+
+    def _get_children(self) -> Dict[str,SObjectSerialized]:
+        if self._children is None:
+            self._children = {child.id: child for child in self.values()}
+        return self._children
+
+    def __getitem__(self, id: str) -> SObjectSerialized:
+        return self._get_children()[id]
+
+    def __iter__(self):
+        return iter(self._get_children())
+
+    def __len__(self):
+        return self._count
+
+    def values(self) -> List[SObjectSerialized]: # type: ignore
+        if self._children is not None:
+            return list(self._children.values())
+        if self._count == 0:
+            return []
+        return self._reader.read_children(self._parent_id)
+
+def load_stream(server: Server, lines: Iterable[str|bytes], parent_id: str = 'root') -> List[SObject]:
+    '''
+    Create the objects of a stream under parent_id while reading it. A file opened in text mode can be passed as lines.
+    Like load_snapshot, the restore is not undoable, and the history is cleared.
+    '''
+    reader = StreamReader(lines)
+    created = []
+    with server.record(allow_reentry=True), server._batch_objects_topic():
+        for serialized in reader.roots():
+            server._create_object(serialized.type, parent_id, serialized.id, serialized)
+            created.append(server.get_object(serialized.id))
+    if reader.id_count > server.get_id_count():
+        server.set_id_count(reader.id_count)
+    server.clear_history_inclusive()
+    return created
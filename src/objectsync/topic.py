@@ -11,6 +11,8 @@ if TYPE_CHECKING:
     from objectsync.sobject import SObject
 
 class WrappedTopic:
+    __slots__ = ('_topic', '_map', 'on_set', 'on_set2')
+
     @classmethod
     def get_type_name(cls):
         return camel_to_snake(cls.__name__[:-5])
@@ -38,6 +40,7 @@ class WrappedTopic:
 
 T = TypeVar('T', bound='SObject')
 class ObjTopic(Generic[T],WrappedTopic):
+    __slots__ = ()
     def __init__(self, topic: StringTopic,map: Callable[[str],T|None]):
         self._topic = topic
         self._map : Callable[[str],T|None] = map
@@ -63,6 +66,7 @@ class ObjTopic(Generic[T],WrappedTopic):
 
 T = TypeVar('T', bound='SObject')
 class ObjListTopic(Generic[T],WrappedTopic):
+    __slots__ = ('on_insert', 'on_pop')
     def __init__(self, topic: ListTopic,map: Callable[[str],T|None]):
         self._topic:ListTopic = topic
         self._map : Callable[[str],T|None] = map
@@ -113,6 +117,7 @@ class ObjListTopic(Generic[T],WrappedTopic):
 
 T = TypeVar('T', bound='SObject')
 class ObjSetTopic(Generic[T],WrappedTopic):
+    __slots__ = ('on_append', 'on_remove')
     def __init__(self, topic: SetTopic,map: Callable[[str],T|None]):
         self._topic:SetTopic = topic
         self._map : Callable[[str],T|None] = map
@@ -153,6 +158,7 @@ class ObjSetTopic(Generic[T],WrappedTopic):
 
 T = TypeVar('T', bound='SObject')    
 class ObjDictTopic(Generic[T],WrappedTopic):
+    __slots__ = ('on_add', 'on_remove', 'on_change_value')
     def __init__(self, topic: DictTopic,map: Callable[[str],T|None]):
         self._topic:DictTopic = topic
         self._map : Callable[[str],T|None] = map
@@ -1,11 +1,13 @@
+import re
 from typing import Any
 
 def camel_to_snake(name):
     return ''.join(['_'+c.lower() if c.isupper() else c for c in name]).lstrip('_')
 
+_snake_pattern = re.compile(r'(?!^)_([a-zA-Z])')
+
 def snake_to_camel(name):
-    import re
-    return re.sub(r'(?!^)_([a-zA-Z])', lambda m: m.group(1).upper(), name)
+    return _snake_pattern.sub(lambda m: m.group(1).upper(), name)
 
 
 class NameSpace: